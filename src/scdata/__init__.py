@@ -1,4 +1,25 @@
-from .api import SoundCloudAPI
-from .crawler import SoundCloudCrawler
+import importlib
+
 from .genre import map_genre
-from .load import get_audio_path
\ No newline at end of file
+from .load import get_audio_path
+
+# The API and the crawler pull in aiohttp, mutagen and numpy, which are slow to import. Users that
+# only need the genre and load utilities (e.g. data loader workers) should not have to pay for
+# this, so these are only imported on first access.
+_LAZY_ATTRIBUTES = {
+    'SoundCloudAPI': 'scdata.api',
+    'SoundCloudCrawler': 'scdata.crawler',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
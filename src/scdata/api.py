@@ -1,5 +1,9 @@
+import asyncio
+import contextvars
 import json
-from typing import Dict
+import os
+import re
+from typing import Callable, Dict, List, Optional
 
 from urllib.parse import quote
 
@@ -9,60 +13,185 @@ import aiohttp.web
 import mutagen
 from mutagen.id3 import ID3, TIT2, COMM, TCON, TDRC, APIC, TPE1
 
+from scdata import decode
+from scdata.artwork import ArtworkStore, get_artwork_url
+from scdata.mp3 import is_mp3_okay, scan_mp3
+from scdata.trace import Trace, TraceMissError
+
 # API v1 does not work for me, defaulting to v2 (which is the one being used by their frontend).
 # See also <https://twitter.com/gdemey/status/639547648970760192>.
 DEFAULT_SERVER = 'https://api-v2.soundcloud.com'
 
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+
+class CallCounter:
+    """
+    Number of API requests that were actually made on behalf of some task, see `call_counters`.
+    """
+
+    def __init__(self):
+        self.num_calls = 0
+
+
+# Counters for the requests made by the current task, e.g. for attributing them to a background
+# task. Tasks that are created by the task inherit them. Coalesced calls are only counted for the
+# task that made the shared request.
+call_counters = contextvars.ContextVar('call_counters', default=())
+
 
 class SoundCloudAPI:
     def __init__(self,
                  session: aiohttp.ClientSession,
                  client_id: str,
                  oauth_token: str,
-                 server: str = DEFAULT_SERVER):
+                 server: str = DEFAULT_SERVER,
+                 typed: bool = False,
+                 trace: Optional[Trace] = None):
         self.session = session
         self.client_id = client_id
         self.oauth_token = oauth_token
         self.server = server
         self.num_calls = 0
 
+        # With `typed`, responses of the endpoints used by the crawler are decoded with the typed
+        # decoders from `scdata.decode`, which only materialize the fields that the crawler needs.
+        if typed and decode.DECODERS is None:
+            raise ValueError('Typed decoding requires msgspec to be installed')
+        self.decoders = decode.DECODERS if typed else {}
+
+        # Requests that are currently in flight, by URL. Concurrent identical calls to `get` share
+        # a single request and its parsed result. Playlists share tracks and likers overlap, so
+        # this happens quite often when expanding a playlist.
+        self.in_flight = {}
+        self.num_coalesced_calls = 0
+
+        # In record mode, successful responses are appended to the trace. In replay mode, all
+        # responses are served from the trace, and no requests are made. See `scdata.trace`.
+        self.trace = trace
+        self.num_trace_misses = 0
+
     def get_num_calls(self):
         return self.num_calls
 
-    async def get(self, resource: str, args: Dict[str, str] = {}, root=None):
+    def get_num_coalesced_calls(self):
+        return self.num_coalesced_calls
+
+    def get_num_trace_misses(self):
+        return self.num_trace_misses
+
+    async def get(self,
+                  resource: str,
+                  args: Dict[str, str] = {},
+                  root=None,
+                  decoder: Optional[Callable] = None):
         if root is None:
             root = self.server + '/'
+        # `next_href` links of paginated collections already come with a query string.
+        separator = '&' if '?' in resource else '?'
+        url_args = '&'.join(f'{key}={quote(value)}' for key, value in args.items())
+        trace_key = f'{root}{resource}{separator}{url_args}' if args else f'{root}{resource}'
         args = {'client_id': self.client_id, **args}
         url_args = '&'.join(f'{key}={quote(value)}' for key, value in args.items())
-        url = f'{root}{resource}?{url_args}'
-        headers = {'Authorization': 'OAuth ' + self.oauth_token}
+        url = f'{root}{resource}{separator}{url_args}'
+
+        if decoder is None:
+            decoder = decode.loads
+
+        key = (url, decoder)
+        entry = self.in_flight.get(key)
+        if entry is None:
+            # The shared request, and the number of callers waiting for it.
+            entry = [asyncio.ensure_future(self.request(url, trace_key, decoder)), 0]
+            self.in_flight[key] = entry
+            entry[0].add_done_callback(lambda _: self.forget_in_flight(key, entry))
+            # If all callers are gone, nobody else retrieves the exception of a failed request.
+            entry[0].add_done_callback(lambda request: request.cancelled() or request.exception())
+        else:
+            self.num_coalesced_calls += 1
+
+        # Shield the shared request, so that one cancelled caller does not cancel it for the
+        # others. Once the last caller is gone, the request is cancelled after all.
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+                self.forget_in_flight(key, entry)
 
+    def forget_in_flight(self, key, entry):
+        if self.in_flight.get(key) is entry:
+            del self.in_flight[key]
+
+    async def request(self, url: str, trace_key: str, decoder: Callable):
         self.num_calls += 1
+        for counter in call_counters.get():
+            counter.num_calls += 1
+
+        if self.trace is not None and self.trace.mode == 'replay':
+            try:
+                data = self.trace.lookup(trace_key)
+            except TraceMissError:
+                self.num_trace_misses += 1
+                raise
+            return decoder(data)
+
+        headers = {'Authorization': 'OAuth ' + self.oauth_token}
 
         async with self.session.get(url, headers=headers) as response:
             data = await response.read()
-            return json.loads(data)
+            if self.trace is not None and response.status == 200:
+                self.trace.record(trace_key, data)
+            return decoder(data)
+
+    async def save_track(self,
+                         track_info,
+                         filename,
+                         artwork_store: Optional[ArtworkStore] = None,
+                         embed_artwork: bool = True,
+                         max_attempts: int = 3):
+        """
+        Download a track and tag it with its metadata.
+
+        The audio is downloaded to `filename + '.part'` first, and only moved to `filename` once it
+        is complete. Interrupted downloads are resumed, see `download_stream`.
 
-    async def save_track(self, track_info, filename):
-        url = None
+        If an artwork store is given, the artwork is taken from (or added to) the store, and it is
+        only embedded into the MP3 file if `embed_artwork` is set.
+        """
+        stream_url = None
         for transcoding in track_info['media']['transcodings']:
             if transcoding['format']['protocol'] == 'progressive':
-                url = transcoding['url']
-        if not url:
+                stream_url = transcoding['url']
+        if not stream_url:
             raise ValueError('No progressive protocol available')
 
-        url = (await self.get(url, root=''))['url']
-        async with self.session.get(url) as response:
-            with open(filename, 'wb') as f:
-                while True:
-                    chunk = await response.content.read(1024)
-                    if not chunk:
-                        break
-                    f.write(chunk)
+        part_filename = filename + '.part'
+        for attempt in range(max_attempts):
+            try:
+                # The resolved URLs are signed and expire after a while, so resolve them again for
+                # each attempt.
+                url = (await self.get(stream_url, root=''))['url']
+                await self.download_stream(url, part_filename)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt + 1 == max_attempts:
+                    raise
+                print(f'Retrying download of "{filename}" after exception {e}')
+
+        os.replace(part_filename, filename)
+        os.remove(part_filename + '.json')
 
-        artwork_url = track_info['artwork_url'].replace('large', 't300x300')
-        async with self.session.get(artwork_url) as response:
-            artwork = await response.read()
+        artwork = None
+        if artwork_store is None:
+            async with self.session.get(get_artwork_url(track_info)) as response:
+                artwork = await response.read()
+        else:
+            checksum = await artwork_store.fetch(self.session, get_artwork_url(track_info))
+            if embed_artwork:
+                artwork = artwork_store.read(checksum)
 
         tags = mutagen.File(filename)
         tags.add_tags()
@@ -70,38 +199,176 @@ class SoundCloudAPI:
         tags['TIT2'] = TIT2(encoding=3, text=track_info['title'])
         tags['TCON'] = TCON(encoding=3, text=track_info['genre'])
         tags['TDRC'] = TDRC(encoding=3, text=track_info['created_at'])
-        tags['APIC'] = APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=artwork)
+        if artwork is not None:
+            tags['APIC'] = APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=artwork)
         tags.save(filename, v1=2)
-         
+
+    async def download_stream(self, url: str, part_filename: str):
+        """
+        Download a stream to `part_filename`, resuming a previous partial download if possible.
+
+        The expected length of the stream is kept in `part_filename + '.json'`. If there is a
+        partial download, only the remaining bytes are requested with a `Range` header. Servers
+        that ignore the header send the whole stream, in which case we start over. Raises a
+        `aiohttp.ClientPayloadError` if the download is incomplete.
+
+        If the server rejects the range, and the partial download is not simply complete already,
+        the partial download is discarded, and we start over.
+        """
+        info_filename = part_filename + '.json'
+        expected_length = None
+        offset = 0
+        if os.path.exists(part_filename) and os.path.exists(info_filename):
+            with open(info_filename) as f:
+                expected_length = json.load(f)['length']
+            offset = os.path.getsize(part_filename)
+
+        headers = {}
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 416:
+                if offset == expected_length:
+                    # The previous attempt got all the data, but was interrupted before finishing.
+                    return
+                if offset > 0:
+                    # E.g. the stream has become shorter than the partial download. Without a
+                    # `Range` header, this cannot happen again.
+                    print(f'Range not satisfiable, restarting download of "{url}"')
+                    response.release()
+                    os.remove(part_filename)
+                    os.remove(info_filename)
+                    return await self.download_stream(url, part_filename)
+
+            response.raise_for_status()
+
+            if response.status == 206:
+                match = CONTENT_RANGE_PATTERN.match(response.headers.get('Content-Range', ''))
+                if match is None or int(match.group(1)) != offset:
+                    raise aiohttp.ClientPayloadError(f'Unexpected range in response for "{url}"')
+                if match.group(2) != '*':
+                    length = int(match.group(2))
+                    if expected_length is not None and length != expected_length:
+                        # The file has changed since the previous attempt.
+                        os.remove(part_filename)
+                        raise aiohttp.ClientPayloadError(f'Length of "{url}" has changed')
+                    expected_length = length
+                mode = 'ab'
+            else:
+                if offset > 0:
+                    print(f'Server does not support resuming, restarting download of "{url}"')
+                offset = 0
+                expected_length = response.content_length
+                mode = 'wb'
+
+            with open(info_filename, 'w') as f:
+                json.dump({'length': expected_length}, f)
+
+            with open(part_filename, mode) as f:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    f.write(chunk)
+
+        # Verify that we got everything before the file is tagged and moved into place. Without a
+        # known length, we check that the last MPEG frame is complete instead.
+        if expected_length is not None:
+            length = os.path.getsize(part_filename)
+            if length != expected_length:
+                raise aiohttp.ClientPayloadError(f'Incomplete download of "{url}": '
+                                                 f'{length}/{expected_length} bytes')
+        elif not is_mp3_okay(scan_mp3(part_filename)):
+            os.remove(part_filename)
+            raise aiohttp.ClientPayloadError(f'Incomplete download of "{url}"')
+
+    async def paginate(self,
+                       resource: str,
+                       limit: Optional[int] = None,
+                       page_size: int = 50,
+                       decoder: Optional[Callable] = None):
+        """
+        Iterate over the items of a paginated collection resource, following `next_href`.
+
+        The next page is requested in the background while the caller is still processing the
+        current one. At most `limit` items are produced, and no further pages are requested once
+        the caller stops iterating.
+        """
+        if limit is not None:
+            if limit <= 0:
+                return
+            page_size = min(page_size, limit)
+
+        num_items = 0
+        page = asyncio.ensure_future(self.get(resource,
+                                              {'limit': str(page_size)},
+                                              decoder=decoder))
+        try:
+            while page is not None:
+                data = await page
+                page = None
+
+                collection = data['collection']
+                next_href = data.get('next_href')
+                remaining = None if limit is None else limit - num_items - len(collection)
+                if collection and next_href and (remaining is None or remaining > 0):
+                    page = asyncio.ensure_future(self.get(next_href, root='', decoder=decoder))
+
+                for item in collection:
+                    yield item
+                    num_items += 1
+                    if limit is not None and num_items >= limit:
+                        return
+        finally:
+            if page is not None:
+                page.cancel()
+
     async def resolve(self, soundcloud_url: str):
         return await self.get('resolve', {'url': soundcloud_url})
 
     async def track(self, track_id: int):
-        return await self.get(f'tracks/{track_id}')
+        return await self.get(f'tracks/{track_id}', decoder=self.decoders.get('track'))
+
+    async def tracks(self, track_ids: List[int]):
+        # Tracks that do not exist (anymore) are missing from the result.
+        return await self.get('tracks',
+                              {'ids': ','.join(str(track_id) for track_id in track_ids)},
+                              decoder=self.decoders.get('tracks'))
 
-    async def track_likers(self, track_id: int):
-        return (await self.get(f'tracks/{track_id}/likers'))['collection']
+    def track_likers(self, track_id: int, limit: Optional[int] = None, page_size: int = 50):
+        return self.paginate(f'tracks/{track_id}/likers', limit, page_size,
+                             decoder=self.decoders.get('users'))
 
-    async def track_playlists(self, track_id: int):
-        return (await self.get(f'tracks/{track_id}/playlists_without_albums'))['collection']
+    def track_playlists(self, track_id: int, limit: Optional[int] = None, page_size: int = 50):
+        return self.paginate(f'tracks/{track_id}/playlists_without_albums', limit, page_size,
+                             decoder=self.decoders.get('playlists'))
 
     async def playlist(self, playlist_id: int):
-        return await self.get(f'playlists/{playlist_id}')
+        return await self.get(f'playlists/{playlist_id}', decoder=self.decoders.get('playlist'))
 
-    async def playlist_likers(self, playlist_id: int):
-        return (await self.get(f'playlists/{playlist_id}/likers'))['collection']
+    def playlist_likers(self, playlist_id: int, limit: Optional[int] = None, page_size: int = 50):
+        return self.paginate(f'playlists/{playlist_id}/likers', limit, page_size,
+                             decoder=self.decoders.get('users'))
 
     async def user(self, user_id: int):
         return await self.get(f'users/{user_id}')
 
-    async def user_followings(self, user_id: int):
-        return (await self.get(f'users/{user_id}/followings'))['collection']
+    def user_followings(self, user_id: int, limit: Optional[int] = None, page_size: int = 50):
+        return self.paginate(f'users/{user_id}/followings', limit, page_size,
+                             decoder=self.decoders.get('users'))
 
     async def user_followers(self, user_id: int):
         return (await self.get(f'users/{user_id}/followers'))['collection']
 
-    async def user_likes(self, user_id: int):
-        return (await self.get(f'users/{user_id}/likes'))['collection']
+    def user_likes(self, user_id: int, limit: Optional[int] = None, page_size: int = 50):
+        return self.paginate(f'users/{user_id}/likes', limit, page_size,
+                             decoder=self.decoders.get('likes'))
 
     async def user_playlists(self, user_id: int):
         return (await self.get(f'users/{user_id}/playlists'))['collection']
+
+
+async def collect(items):
+    """
+    Collect the items of an async iterator, e.g. one returned by `SoundCloudAPI.paginate`, into a
+    list.
+    """
+    return [item async for item in items]
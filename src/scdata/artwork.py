@@ -0,0 +1,128 @@
+"""
+Content-addressed store for track artwork.
+
+Many tracks (e.g. those of the same uploader) share the same artwork URL, and different URLs can
+still have identical images. The store downloads every distinct URL only once, and keeps each
+distinct image only once, under its MD5 checksum:
+```
+artwork/index.json                              # Maps artwork URLs to checksums.
+artwork/d4/d41d8cd98f00b204e9800998ecf8427e.jpg
+```
+Since tracks reference their cover by checksum, deduplicating tracks by cover is just a lookup.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from typing import Iterable, Optional
+
+from mutagen.id3 import ID3, ID3NoHeaderError
+
+
+def get_artwork_url(track_info):
+    # The `artwork_url` returned by the API is for a small version of the image.
+    return track_info['artwork_url'].replace('large', 't300x300')
+
+
+def read_embedded_artwork(audio_path: str) -> Optional[bytes]:
+    """
+    Read the cover that is embedded into an MP3 file, if there is one.
+    """
+    try:
+        covers = ID3(audio_path).getall('APIC')
+    except ID3NoHeaderError:
+        return None
+    return covers[0].data if covers else None
+
+
+class ArtworkStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.index_path = os.path.join(root, 'index.json')
+
+        os.makedirs(root, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+        # Downloads that are in progress, by URL, so that concurrent requests for the same URL
+        # share one download.
+        self.pending = {}
+
+    def get_path(self, checksum: str) -> str:
+        return os.path.join(self.root, checksum[:2], checksum + '.jpg')
+
+    def get_checksum(self, url: str) -> Optional[str]:
+        return self.index.get(url)
+
+    def get_track_checksum(self, track_info) -> Optional[str]:
+        return self.get_checksum(get_artwork_url(track_info))
+
+    def read(self, checksum: str) -> bytes:
+        with open(self.get_path(checksum), 'rb') as f:
+            return f.read()
+
+    def save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    async def fetch(self, session, url: str) -> str:
+        """
+        Make sure that the image at the given URL is in the store, and return its checksum.
+        """
+        checksum = self.index.get(url)
+        if checksum is not None:
+            return checksum
+
+        download = self.pending.get(url)
+        if download is None:
+            download = asyncio.ensure_future(self.download(session, url))
+            self.pending[url] = download
+            download.add_done_callback(lambda _: self.pending.pop(url, None))
+
+        return await asyncio.shield(download)
+
+    async def download(self, session, url: str) -> str:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            data = await response.read()
+
+        return self.add(url, data)
+
+    def add(self, url: str, data: bytes) -> str:
+        """
+        Add the image that was downloaded from the given URL, and return its checksum.
+        """
+        checksum = hashlib.md5(data).hexdigest()
+        path = self.get_path(checksum)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        self.index[url] = checksum
+        return checksum
+
+    async def fetch_all(self, session, urls: Iterable[str], concurrency: int = 16) -> int:
+        """
+        Fetch all distinct URLs that are not in the store yet, with up to `concurrency` downloads
+        at a time. Returns the number of failed downloads.
+        """
+        urls = set(url for url in urls if url not in self.index)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_one(url):
+            async with semaphore:
+                return await self.fetch(session, url)
+
+        results = await asyncio.gather(*[fetch_one(url) for url in urls], return_exceptions=True)
+        self.save_index()
+
+        return sum(1 for result in results if isinstance(result, Exception))
@@ -0,0 +1,104 @@
+from typing import Dict, List
+
+
+class FanoutBudget:
+    """
+    Split a per-step budget of API calls between the different ways of expanding a playlist.
+
+    Each way of expanding (an "arm", e.g. looking up the playlists of a track, or the likes of a
+    user) is a bandit arm. We keep a running estimate of its yield per API call, and of how many
+    calls one unit of expansion (one track, one user) costs. Older observations decay, since the
+    yield changes as the crawl progresses.
+
+    Every arm gets at least `min_share` of the budget, so that we keep measuring arms that are
+    currently unproductive. The rest of the budget is split proportionally to the estimated yield.
+
+    A unit costs at least `min_calls_per_unit` calls. Otherwise, a few expansions that were cheaper
+    than expected (e.g. users without likes) would make the next allocations explode.
+    """
+
+    def __init__(self,
+                 arms: List[str],
+                 num_calls: int,
+                 min_share: float = 0.1,
+                 decay: float = 0.95,
+                 prior_yield: float = 1.0,
+                 min_calls_per_unit: float = 1.0):
+        assert min_share * len(arms) <= 1.0
+
+        self.arms = list(arms)
+        self.num_calls = num_calls
+        self.min_share = min_share
+        self.decay = decay
+        self.min_calls_per_unit = min_calls_per_unit
+
+        # Decayed sums of observations per arm. The prior counts as one unit that costs one call.
+        self.yields = {arm: prior_yield for arm in self.arms}
+        self.calls = {arm: 1.0 for arm in self.arms}
+        self.units = {arm: 1.0 for arm in self.arms}
+
+    def get_yield_per_call(self, arm: str) -> float:
+        return self.yields[arm] / self.calls[arm]
+
+    def get_calls_per_unit(self, arm: str) -> float:
+        return max(self.min_calls_per_unit, self.calls[arm] / self.units[arm])
+
+    def allocate(self) -> Dict[str, int]:
+        """
+        Return the number of units to expand per arm in the next step. The expected calls of all
+        arms add up to at most `num_calls`.
+        """
+        yields = {arm: self.get_yield_per_call(arm) for arm in self.arms}
+        total_yield = sum(yields.values())
+
+        free_share = 1.0 - self.min_share * len(self.arms)
+
+        allocation = {}
+        for arm in self.arms:
+            if total_yield > 0.0:
+                share = self.min_share + free_share * yields[arm] / total_yield
+            else:
+                share = 1.0 / len(self.arms)
+
+            arm_calls = share * self.num_calls
+            # Round down, so that the total stays within the budget.
+            allocation[arm] = int(arm_calls / self.get_calls_per_unit(arm))
+
+        return allocation
+
+    def get_max_units(self, arm: str, num_calls: float) -> int:
+        """
+        Return the number of units of `arm` that can be expanded with `num_calls` calls.
+        """
+        return max(0, int(min(num_calls, self.num_calls) / self.get_calls_per_unit(arm)))
+
+    def update(self, arm: str, value: float, num_calls: int, num_units: int):
+        """
+        Record that expanding `num_units` units of `arm` took `num_calls` API calls and yielded
+        `value`.
+        """
+        if num_calls == 0:
+            return
+
+        self.yields[arm] = self.decay * self.yields[arm] + value
+        self.calls[arm] = self.decay * self.calls[arm] + num_calls
+        self.units[arm] = self.decay * self.units[arm] + num_units
+
+    def pp(self) -> str:
+        return ', '.join(f'{arm} {self.get_yield_per_call(arm):.3f}/call '
+                         f'({self.get_calls_per_unit(arm):.2f} calls/unit)'
+                         for arm in self.arms)
+
+    def state_dict(self):
+        return {
+            'yields': self.yields,
+            'calls': self.calls,
+            'units': self.units,
+        }
+
+    def load_state_dict(self, state):
+        for arm in self.arms:
+            if arm in state['yields']:
+                self.yields[arm] = state['yields'][arm]
+                self.calls[arm] = state['calls'][arm]
+                self.units[arm] = state['units'][arm]
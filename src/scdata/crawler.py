@@ -3,23 +3,44 @@ import json
 from collections import Counter
 import heapq
 import math
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 
 import asyncio
 import aiohttp
 import aiohttp.web
 
-from scdata import SoundCloudAPI
+from scdata.api import CallCounter, SoundCloudAPI, call_counters, collect
+from scdata.budget import FanoutBudget
+from scdata.sketch import TrackSketch
 from scdata.genre import (GENRES,
+                          GENRE_CODES,
                           IGNORE_GENRES,
                           normalize_distr,
                           bhattacharyya_dist,
                           map_genre,
+                          genre_code,
                           genre_distr,
                           pp_distr)
 
 
+# Track info keys that are updated by `SoundCloudCrawler.refresh_tracks`.
+REFRESH_KEYS = [
+    'artwork_url',
+    'downloadable',
+    'genre',
+    'has_downloads_left',
+    'license',
+    'likes_count',
+    'media',
+    'playback_count',
+    'title',
+]
+
+
 def playlist_distr(playlist_info):
     genres = [track_info['genre']
               for track_info in playlist_info['tracks']
@@ -31,19 +52,79 @@ class SoundCloudCrawler:
     def __init__(self,
                  api: SoundCloudAPI,
                  min_track_likes: int = 30,
-                 min_track_plays: int = 200):
+                 min_track_plays: int = 200,
+                 max_track_playlists: int = 50,
+                 max_user_likes: int = 200,
+                 max_useful_user_likes: int = 50,
+                 expansion_calls: int = 56,
+                 candidate_value: float = 0.1,
+                 max_candidates: int = 200000,
+                 evict_fraction: float = 0.1,
+                 prefetch_top_k: int = 3,
+                 prefetch_calls: int = 100,
+                 sketch_non_free_tracks: bool = False):
         self.api = api
         self.min_track_likes = min_track_likes
         self.min_track_plays = min_track_plays
 
+        # Fan-out limits for expanding a playlist. Collections are paginated, so these bound the
+        # number of items we look at rather than the number of API calls.
+        self.max_track_playlists = max_track_playlists
+        self.max_user_likes = max_user_likes
+        self.max_useful_user_likes = max_useful_user_likes
+
+        # After filling the tracks of a playlist, we have `expansion_calls` API calls per step for
+        # finding new candidates and tracks. They are split between the expansions according to
+        # how many new complete tracks (and, with weight `candidate_value`, new useful candidate
+        # playlists) each of them has recently found per API call.
+        self.fanout_budget = FanoutBudget(['track_playlists', 'user_likes'], expansion_calls)
+        self.candidate_value = candidate_value
+        self.num_new_complete_tracks = 0
+        self.num_new_useful_candidates = 0
+
         self.visited_tracks = set()
         self.visited_playlists = set()
         self.visited_users = set()
 
+        # Candidate playlists are stored as compact summaries (see `summarize_candidate_playlist`).
+        # Once there are more than `max_candidates`, the least valuable and stalest
+        # `evict_fraction` of them are evicted.
         self.candidate_playlists = {}
+        self.max_candidates = max_candidates
+        self.evict_fraction = evict_fraction
+        self.num_candidate_insertions = 0
+        self.num_evicted_candidates = 0
 
         self.tracks = {}
 
+        # Counts of the (mapped) genres of the free tracks in `self.tracks`. These are kept up to
+        # date by `store_track` and `refresh_tracks`, so that scoring does not need to go over all
+        # the tracks in each step.
+        self.free_genre_counts = Counter()
+
+        # Non-free tracks are only needed for statistics. With `sketch_non_free_tracks`, they are
+        # not stored individually, but only counted in `track_sketch` (see `scdata.sketch`).
+        self.track_sketch = TrackSketch() if sketch_non_free_tracks else None
+
+        # Playlists are scored in a worker thread, and the next playlist is chosen while the
+        # current one is being visited. See `crawl_step`.
+        self.scoring_executor = ThreadPoolExecutor(max_workers=1)
+        self.next_choice = None
+
+        # After each choice, the playlist details and the incomplete track infos of the
+        # `prefetch_top_k` best-scored candidates are fetched in the background, using up to
+        # `prefetch_calls` API calls per choice. Most of the time the chosen playlist is among them,
+        # so `visit_playlist` can start right away. See `prefetch_playlist`.
+        self.prefetch_top_k = prefetch_top_k
+        self.prefetch_calls = prefetch_calls
+        self.prefetch_calls_left = prefetch_calls
+        self.top_candidates = []
+        self.prefetches = {}
+        self.num_prefetches = 0
+        self.num_prefetch_hits = 0
+        self.prefetch_call_counter = CallCounter()
+        self.num_wasted_prefetch_calls = 0
+
     def save_state(self, path):
         state = {
             'min_track_likes': self.min_track_likes,
@@ -52,8 +133,12 @@ class SoundCloudCrawler:
             'visited_playlists': list(self.visited_playlists),
             'visited_users': list(self.visited_users),
             'candidate_playlists': self.candidate_playlists,
+            'num_candidate_insertions': self.num_candidate_insertions,
             'tracks': self.tracks,
-        }                 
+            'fanout_budget': self.fanout_budget.state_dict(),
+        }
+        if self.track_sketch is not None:
+            state['track_sketch'] = self.track_sketch.state_dict()                 
 
         with open(path, 'w') as f:
             json.dump(state, f)
@@ -73,11 +158,21 @@ class SoundCloudCrawler:
         # and the other is an integer.
         #
         # Prevent this issue by converting keys back to integer after deserialization.
-        self.tracks = {int(track_id): self.strip_track_info(track_info)
-                       for track_id, track_info
-                       in state['tracks'].items()}
-        self.candidate_playlists = {int(playlist_id): playlist_info for playlist_id, playlist_info
-                                    in state['candidate_playlists'].items()}
+        if 'track_sketch' in state:
+            self.track_sketch = TrackSketch.from_state_dict(state['track_sketch'])
+        self.tracks = {}
+        self.free_genre_counts = Counter()
+        for track_info in state['tracks'].values():
+            self.store_track(track_info)
+        self.num_candidate_insertions = state.get('num_candidate_insertions', 0)
+        self.candidate_playlists = {}
+        for playlist_id, playlist_info in state['candidate_playlists'].items():
+            # Older states store the full playlist info for each candidate.
+            if 'track_ids' not in playlist_info:
+                playlist_info = self.summarize_candidate_playlist(playlist_info)
+            self.candidate_playlists[int(playlist_id)] = playlist_info
+        if 'fanout_budget' in state:
+            self.fanout_budget.load_state_dict(state['fanout_budget'])
 
     def is_complete_track_info(self, info):
         # Some info may be incomplete, e.g. the playlist.tracks infos are complete only for the
@@ -108,7 +203,9 @@ class SoundCloudCrawler:
 
         return True
 
-    def is_track_complete(self, track):
+    def is_track_complete(self, track, check_available=True):
+        if check_available and track.get('scdata_unavailable'):
+            return False
         mapped_genre = map_genre(track.get('genre'))
         if mapped_genre in ['others', 'ignore', 'unknown']:
             return False
@@ -124,9 +221,24 @@ class SoundCloudCrawler:
             return False
         return True
 
-    def strip_track_info(self, info):
-        # Non-free tracks are only kept around for statistics, so we can remove other fields.
+    def is_statistics_only(self, info):
+        # Non-free tracks are only kept around for statistics. Tracks that used to be free are the
+        # exception, since they may have been downloaded already.
+        return not self.is_free(info.get('license')) and 'scdata_license_changed_at' not in info
+
+    def mark_license_change(self, info, previous_info):
+        """
+        Flag the track if it was free according to `previous_info`, but is not free anymore.
+        """
         if self.is_free(info.get('license')):
+            info.pop('scdata_license_changed_at', None)
+        elif previous_info is not None and not self.is_statistics_only(previous_info):
+            info['scdata_license_changed_at'] = previous_info.get('scdata_license_changed_at',
+                                                                  int(time.time()))
+
+    def strip_track_info(self, info):
+        # We can remove the fields that are not needed for statistics.
+        if not self.is_statistics_only(info):
             return info
         else:
             return {
@@ -135,11 +247,105 @@ class SoundCloudCrawler:
                 'license': info.get('license'),
             }
 
+    def add_track(self, track_info):
+        """
+        Record the given track if it is okay. Returns whether the track was recorded.
+        """
+        if not self.is_track_okay(track_info):
+            return False
+
+        if track_info['id'] not in self.tracks and self.is_track_complete(track_info):
+            self.num_new_complete_tracks += 1
+
+        if self.is_free(track_info['license']):
+            # Used for scheduling metadata refreshes, see `refresh_tracks`.
+            track_info['scdata_fetched_at'] = int(time.time())
+
+        previous_info = self.tracks.get(track_info['id'])
+        if previous_info is not None and not self.is_statistics_only(previous_info) \
+                and not self.is_free(track_info['license']):
+            # The track is not free anymore. With typed decoding, `track_info` only has the fields
+            # that we look at, so like `refresh_tracks`, update the stored metadata instead of
+            # replacing it.
+            merged_info = dict(previous_info)
+            merged_info.update((key, track_info[key]) for key in REFRESH_KEYS if key in track_info)
+            track_info = merged_info
+        self.mark_license_change(track_info, previous_info)
+
+        self.store_track(track_info)
+        return True
+
+    def store_track(self, track_info):
+        """
+        Store the (stripped) track info, or only count the track in the track sketch if it is not
+        free and we have one.
+        """
+        self.count_free_genre(self.tracks.get(track_info['id']), -1)
+        if self.track_sketch is not None and self.is_statistics_only(track_info):
+            self.tracks.pop(track_info['id'], None)
+            self.track_sketch.add(track_info)
+        else:
+            self.tracks[track_info['id']] = self.strip_track_info(track_info)
+            self.count_free_genre(track_info, 1)
+
+    def count_free_genre(self, info, count):
+        if info is not None and self.is_free(info.get('license')):
+            self.free_genre_counts[map_genre(info.get('genre'))] += count
+
+    def is_known_track(self, track_id):
+        # Due to false positives of the track sketch, this is only good enough for scoring. Whether
+        # a track is stored must be decided with `self.tracks` alone.
+        return track_id in self.tracks \
+            or (self.track_sketch is not None and track_id in self.track_sketch)
+
+    def get_known_tracks(self, track_ids):
+        """
+        Vectorized `is_known_track` for a list of track IDs. Returns a boolean array.
+
+        Used for scoring, which needs this for every track of every candidate. The track sketch is
+        only fast when it is queried with many IDs at once.
+        """
+        known = np.fromiter((track_id in self.tracks for track_id in track_ids),
+                            dtype=bool,
+                            count=len(track_ids))
+        if self.track_sketch is not None and len(track_ids) > 0:
+            known |= self.track_sketch.contains_many(np.array(track_ids, dtype=np.int64))
+        return known
+
+    def get_sketch_counts(self):
+        """
+        Returns the number of tracks, and the counts per license and per genre, of the track sketch,
+        without the tracks that have been stored since (e.g. because they became free).
+
+        A stored track that is a false positive of the sketch is taken out as well, and the genre
+        of a track may have changed, so this is approximate.
+        """
+        num_tracks = len(self.track_sketch)
+        licenses = Counter(self.track_sketch.licenses)
+        genres = Counter(self.track_sketch.genres)
+        in_sketch = self.track_sketch.contains_many(np.fromiter(self.tracks,
+                                                                dtype=np.int64,
+                                                                count=len(self.tracks)))
+        for info, is_sketched in zip(self.tracks.values(), in_sketch):
+            if is_sketched:
+                # Only tracks that were not free have been sketched.
+                num_tracks -= 1
+                licenses['all-rights-reserved'] -= 1
+                genres[info.get('genre')] -= 1
+        # Unary plus drops the counts that went below zero.
+        return max(num_tracks, 0), +licenses, +genres
+
     def print_info(self):
         licenses = Counter(info['license'] for info in self.tracks.values())
-        free_count = sum(1 if self.is_free(info['license']) else 0
-                         for info in self.tracks.values())
-        free_perc = free_count / len(self.tracks) * 100
+        genres = Counter(info.get('genre') for info in self.tracks.values())
+        if self.track_sketch is not None:
+            num_sketched, sketched_licenses, sketched_genres = self.get_sketch_counts()
+            licenses.update(sketched_licenses)
+            genres.update(sketched_genres)
+        num_tracks = sum(licenses.values())
+
+        free_count = sum(count for license, count in licenses.items() if self.is_free(license))
+        free_perc = free_count / num_tracks * 100
 
         complete_tracks = Counter()
         complete_nodl_tracks = Counter()
@@ -160,25 +366,35 @@ class SoundCloudCrawler:
             complete_tracks[mapped_genre] += 1
             complete_count += 1
 
-        ignore_genres = Counter(track.get('genre') for track in self.tracks.values()
-                                if map_genre(track.get('genre')) == 'ignore')
-        other_genres = Counter(track.get('genre') for track in self.tracks.values()
-                               if map_genre(track.get('genre')) == 'others')
+        ignore_genres = Counter({genre: count for genre, count in genres.items()
+                                 if map_genre(genre) == 'ignore'})
+        other_genres = Counter({genre: count for genre, count in genres.items()
+                                if map_genre(genre) == 'others'})
         ignore_count = sum(ignore_genres.values())
         other_count = sum(other_genres.values())
-        ignore_perc = ignore_count / len(self.tracks) * 100
-        other_perc = other_count / len(self.tracks) * 100
-        complete_perc = complete_count / len(self.tracks) * 100
-        complete_nodl_perc = complete_nodl_count / len(self.tracks) * 100
+        ignore_perc = ignore_count / num_tracks * 100
+        other_perc = other_count / num_tracks * 100
+        complete_perc = complete_count / num_tracks * 100
+        complete_nodl_perc = complete_nodl_count / num_tracks * 100
 
         print('=================================================================================')
         if self.api:
             print(f'#api_calls:           {self.api.get_num_calls()}')
+            print(f'#api_coalesced_calls: {self.api.get_num_coalesced_calls()}')
+            if self.api.trace is not None and self.api.trace.mode == 'replay':
+                print(f'#api_trace_misses:    {self.api.get_num_trace_misses()}')
         print(f'#visited_tracks:      {len(self.visited_tracks)}')
         print(f'#visited_playlists:   {len(self.visited_playlists)}')
         print(f'#visited_users:       {len(self.visited_users)}')
         print(f'#candidate_playlists: {len(self.candidate_playlists)}')
-        print(f'#tracks:              {len(self.tracks)}')
+        print(f'#evicted_candidates:  {self.num_evicted_candidates}')
+        print(f'#prefetches:          {self.num_prefetches}')
+        print(f'    #hits:            {self.num_prefetch_hits}')
+        print(f'    #calls:           {self.prefetch_call_counter.num_calls}')
+        print(f'    #wasted_calls:    {self.num_wasted_prefetch_calls}')
+        print(f'#tracks:              {num_tracks}')
+        if self.track_sketch is not None:
+            print(f'    #sketched:        {num_sketched}')
         print(f'    #free:            {free_count} ({free_perc:.2f}%)')
         print(f'    #ignore_genre:    {ignore_count} ({ignore_perc:.2f}%)')
         print(f'    #other_genre:     {other_count} ({other_perc:.2f}%)')
@@ -197,11 +413,14 @@ class SoundCloudCrawler:
         return int('license' in info and self.is_free(info['license'])) 
 
     def get_tracks_genre_distr(self):
-        return genre_distr(info.get('genre') for info in self.tracks.values())
+        genres = Counter(info.get('genre') for info in self.tracks.values())
+        if self.track_sketch is not None:
+            genres.update(self.get_sketch_counts()[2])
+        return genre_distr(genres.elements())
 
     def get_free_tracks_genre_distr(self):
-        return genre_distr(info.get('genre') for info in self.tracks.values()
-                           if self.is_free(info['license']))
+        # Unary plus drops the genres whose count went down to zero.
+        return normalize_distr(+self.free_genre_counts)
 
     def add_candidate_playlist(self, playlist_info):
         if playlist_info['id'] in self.visited_playlists:
@@ -209,16 +428,153 @@ class SoundCloudCrawler:
         if not playlist_info.get('tracks', []):
             return
 
-        genres = [track['genre'] for track in playlist_info['tracks']
-                  if track.get('genre') is not None]
-        genre_counts = Counter(map_genre(genre) for genre in genres)
+        summary = self.summarize_candidate_playlist(playlist_info)
 
-        self.candidate_playlists[playlist_info['id']] = playlist_info
+        if playlist_info['id'] not in self.candidate_playlists \
+                and any(self.is_track_complete(track_info)
+                        for track_info in playlist_info['tracks']
+                        if self.is_complete_track_info(track_info)):
+            self.num_new_useful_candidates += 1
+
+        # Re-inserting a candidate refreshes it, so that it is not considered stale.
+        self.candidate_playlists.pop(playlist_info['id'], None)
+        self.candidate_playlists[playlist_info['id']] = summary
+
+        if len(self.candidate_playlists) > self.max_candidates:
+            self.evict_candidate_playlists()
 
         # We get up to five full track infos for free per playlist. Record them.
         for track_info in playlist_info['tracks']:
-            if self.is_track_okay(track_info):
-                self.tracks[track_info['id']] = self.strip_track_info(track_info)
+            self.add_track(track_info)
+
+    def summarize_candidate_playlist(self, playlist_info):
+        """
+        Compute the summary of a candidate playlist that is needed for scoring it.
+
+        The summary consists of the IDs of all tracks in the playlist, and, for the tracks that have
+        complete info, a tuple `(track_id, genre_code, is_free, is_okay)`. It also records when the
+        candidate was inserted, so that we can tell stale candidates apart.
+        """
+        complete = [(track_info['id'],
+                     genre_code(track_info['genre']),
+                     int(self.is_free(track_info['license'])),
+                     int(self.is_track_okay(track_info)))
+                    for track_info in playlist_info['tracks']
+                    if self.is_complete_track_info(track_info)]
+
+        self.num_candidate_insertions += 1
+
+        return {
+            'track_ids': [track_info['id'] for track_info in playlist_info['tracks']],
+            'complete': complete,
+            'inserted': self.num_candidate_insertions,
+        }
+
+    def get_candidate_value(self, summary):
+        # Genre-independent part of the playlist score, used for deciding which candidates to
+        # evict. See `choose_playlist`.
+        value = 0.0
+        for track_id, _, is_free, is_okay in summary['complete']:
+            track_value = 1.0 if is_free else 0.00005
+            track_value *= 1.0 if is_okay else 0.01
+            track_value *= 1.0 if not self.is_known_track(track_id) else 0.01
+            value += track_value
+
+        return value
+
+    def evict_candidate_playlists(self):
+        num_evict = max(1, int(self.evict_fraction * len(self.candidate_playlists)))
+        evict = heapq.nsmallest(num_evict,
+                                self.candidate_playlists.items(),
+                                key=lambda item: (self.get_candidate_value(item[1]),
+                                                  item[1]['inserted']))
+
+        for playlist_id, _ in evict:
+            del self.candidate_playlists[playlist_id]
+
+        self.num_evicted_candidates += len(evict)
+
+    def get_refresh_priority(self, track, now):
+        # Stale tracks first, and among similarly stale tracks, the popular ones. Tracks from older
+        # states do not have a fetch time, so they are considered to be the most stale.
+        staleness = now - track.get('scdata_fetched_at', 0)
+        importance = 1.0 + math.log1p(track['likes_count'] or 0)
+        return staleness * importance
+
+    async def refresh_tracks(self,
+                             max_calls: int,
+                             batch_size: int = 50,
+                             min_age: float = 7 * 24 * 3600,
+                             concurrency: int = 10):
+        """
+        Re-fetch the metadata of complete tracks, since licenses and download availability change.
+
+        The most stale and important tracks are refreshed first, using at most `max_calls` batched
+        requests of `batch_size` tracks each. Tracks that have been fetched less than `min_age`
+        seconds ago are skipped. Only the fields that changed are updated.
+
+        Tracks that are no longer free or no longer available are flagged (with the time at which
+        this was noticed), so that they are not considered complete anymore. They may have been
+        downloaded already, so their metadata is kept, and they are checked again by later
+        refreshes, in case they come back.
+        """
+        now = time.time()
+        tracks = [track for track in self.tracks.values()
+                  if (self.is_track_complete(track, check_available=False)
+                      or 'scdata_license_changed_at' in track)
+                  and now - track.get('scdata_fetched_at', 0) >= min_age]
+        tracks = heapq.nlargest(max_calls * batch_size,
+                                tracks,
+                                key=lambda track: self.get_refresh_priority(track, now))
+        batches = [tracks[i:i+batch_size] for i in range(0, len(tracks), batch_size)]
+
+        print(f'Refreshing {len(tracks)} tracks in {len(batches)} batches')
+
+        changed_fields = Counter()
+        num_unavailable = 0
+        num_not_free = 0
+        num_back = 0
+
+        for i in range(0, len(batches), concurrency):
+            group = batches[i:i+concurrency]
+            responses = await asyncio.gather(*[self.api.tracks([track['id'] for track in batch])
+                                               for batch in group])
+
+            for batch, track_infos in zip(group, responses):
+                track_infos = {track_info['id']: track_info for track_info in track_infos}
+
+                for track in batch:
+                    track_info = track_infos.get(track['id'])
+                    track['scdata_fetched_at'] = int(time.time())
+                    if track_info is None:
+                        # Deleted or made private, possibly only for a while.
+                        track['scdata_unavailable'] = True
+                        track.setdefault('scdata_unavailable_at', track['scdata_fetched_at'])
+                        num_unavailable += 1
+                        continue
+
+                    was_flagged = (track.pop('scdata_unavailable', False)
+                                   or 'scdata_license_changed_at' in track)
+                    track.pop('scdata_unavailable_at', None)
+
+                    previous_info = dict(track)
+                    for key in REFRESH_KEYS:
+                        if key in track_info and track.get(key) != track_info[key]:
+                            track[key] = track_info[key]
+                            changed_fields[key] += 1
+                    self.mark_license_change(track, previous_info)
+                    self.count_free_genre(previous_info, -1)
+                    self.count_free_genre(track, 1)
+
+                    if 'scdata_license_changed_at' in track:
+                        num_not_free += 1
+                    elif was_flagged:
+                        num_back += 1
+
+        print(f'#unavailable={num_unavailable}, '
+              f'#not_free={num_not_free}, '
+              f'#back={num_back}, '
+              f'changed_fields={changed_fields.most_common()}')
 
     async def add_candidate_playlist_url(self, soundcloud_url: str):
         info = await self.api.resolve(soundcloud_url) 
@@ -235,13 +591,20 @@ class SoundCloudCrawler:
             return
         self.visited_playlists.add(playlist_id)
 
-        playlist_info = await self.api.playlist(playlist_id)
+        prefetched = await self.get_prefetched_playlist(playlist_id)
+        if prefetched is not None:
+            playlist_info, track_infos = prefetched
+            print('    prefetched')
+        else:
+            playlist_info = await self.api.playlist(playlist_id)
+            track_infos = playlist_info['tracks'][:100]
 
         print('    genres: ' + pp_distr(playlist_distr(playlist_info)))
 
+        # A prefetch may have run out of calls before filling all tracks.
         track_infos = [
             self.fill_track_info(track_info)
-            for track_info in playlist_info['tracks'][:100]
+            for track_info in track_infos
         ]
         track_infos = await asyncio.gather(*track_infos)
 
@@ -263,6 +626,8 @@ class SoundCloudCrawler:
             if self.is_free(track_info['license']):
                 num_free += 1
 
+            # Don't use `is_known_track` here, a false positive of the track sketch would drop a new
+            # free track. Sketched tracks are not counted twice by the sketch anyway.
             if track_info['id'] in self.tracks:
                 num_known += 1
                 skip = True
@@ -279,49 +644,49 @@ class SoundCloudCrawler:
             if self.is_free(track_info['license']):
                 num_new_free += 1
 
-            self.tracks[track_info['id']] = self.strip_track_info(track_info)
+            self.add_track(track_info)
 
             track_score = self.get_track_freeness(track_info)
             track_scores.append((track_info, track_score))
 
+        allocation = self.fanout_budget.allocate()
+
         # For the top free tracks added, add the playlists that they are in as candidates.
-        # I've tried doing this for all new tracks, but it takes too long to do all the API calls.
+        # Doing this for all new tracks takes too many API calls, so the number of tracks we expand
+        # is decided by the fan-out budget.
         track_scores.sort(key=lambda item: item[1], reverse=True)
-        track_playlists = [
-            self.api.track_playlists(track_item[0]['id'])
-            for track_item in track_scores[:5]
-        ]
-        track_playlists = await asyncio.gather(*track_playlists)
-
-        for playlist_infos in track_playlists:
-            for playlist_info in playlist_infos:
-                self.add_candidate_playlist(playlist_info)
-
-        # Try to expand our tastes a bit:
-        likers = await self.api.playlist_likers(playlist_id)
-        user_likes = [
-            self.api.user_likes(liker['id'])
-            for liker in likers[:50]
-            if liker['id'] not in self.visited_users
-        ]
-        user_likes = await asyncio.gather(*user_likes)
-
-        num_new_user_tracks = 0
-        num_new_user_tracks_free = 0
-
-        for liker, likes in zip(likers[:50], user_likes):
-            self.visited_users.add(liker['id'])
-            for like in likes:
-                if 'playlist' in like:
-                    self.add_candidate_playlist(like['playlist'])
-                if 'track' in like:
-                    track_info = like['track']
-                    if self.is_track_okay(track_info):
-                        self.tracks[track_info['id']] = self.strip_track_info(track_info)
-                        num_new_user_tracks += 1
-                        if self.is_free(track_info['license']):
-                            num_new_user_tracks_free += 1
-
+        track_items = track_scores[:allocation['track_playlists']]
+        with self.measure_expansion('track_playlists', len(track_items)):
+            track_playlists = [
+                collect(self.api.track_playlists(track_item[0]['id'],
+                                                 limit=self.max_track_playlists))
+                for track_item in track_items
+            ]
+            track_playlists = await asyncio.gather(*track_playlists)
+
+            for playlist_infos in track_playlists:
+                for playlist_info in playlist_infos:
+                    self.add_candidate_playlist(playlist_info)
+
+        # Try to expand our tastes a bit. If there were fewer new tracks than the budget allowed for,
+        # spend the remaining calls here.
+        unused_calls = ((allocation['track_playlists'] - len(track_items))
+                        * self.fanout_budget.get_calls_per_unit('track_playlists'))
+        user_likes_calls = (allocation['user_likes']
+                            * self.fanout_budget.get_calls_per_unit('user_likes'))
+        num_likers = self.fanout_budget.get_max_units('user_likes', user_likes_calls + unused_calls)
+        user_stats = []
+        with self.measure_expansion('user_likes', 0) as expansion:
+            if num_likers > 0:
+                likers = await collect(self.api.playlist_likers(playlist_id, limit=num_likers))
+                likers = [liker for liker in likers if liker['id'] not in self.visited_users]
+                # Only the likers that we actually expand count as units.
+                expansion['num_units'] = len(likers)
+                user_stats = await asyncio.gather(*[self.expand_user_likes(liker['id'])
+                                                    for liker in likers])
+
+        num_new_user_tracks = sum(stats[0] for stats in user_stats)
+        num_new_user_tracks_free = sum(stats[1] for stats in user_stats)
 
         print(f'    #total={num_total}, '
               f'#known={num_known}, '
@@ -331,60 +696,266 @@ class SoundCloudCrawler:
               f'#new_free={num_new_free}; '
               f'#new_user_tracks={num_new_user_tracks}, '
               f'#new_user_tracks_free={num_new_user_tracks_free}')
+        print(f'    fanout: {allocation}, {self.fanout_budget.pp()}')
+
+    @contextmanager
+    def measure_expansion(self, arm, num_units):
+        """
+        Measure the API calls and the yield of an expansion, and report them to the fan-out budget.
+        Yields a dict, in which `num_units` can be corrected once the actual number is known.
+
+        The budget is also updated if the expansion fails, since the calls were made anyway.
+        """
+        # Prefetches run concurrently, so their calls are not part of the expansion.
+        num_calls = self.api.get_num_calls() - self.prefetch_call_counter.num_calls
+        num_new_complete_tracks = self.num_new_complete_tracks
+        num_new_useful_candidates = self.num_new_useful_candidates
+        expansion = {'num_units': num_units}
+
+        try:
+            yield expansion
+        finally:
+            value = (self.num_new_complete_tracks - num_new_complete_tracks
+                     + self.candidate_value * (self.num_new_useful_candidates
+                                               - num_new_useful_candidates))
+            self.fanout_budget.update(arm,
+                                      value=value,
+                                      num_calls=(self.api.get_num_calls()
+                                                 - self.prefetch_call_counter.num_calls
+                                                 - num_calls),
+                                      num_units=expansion['num_units'])
+
+    async def expand_user_likes(self, user_id):
+        """
+        Record the tracks and playlists liked by a user.
+
+        The likes are paginated, and we stop early once we have seen enough useful likes, i.e.
+        okay tracks or candidate playlists. Returns the number of recorded tracks and free tracks.
+        """
+        self.visited_users.add(user_id)
+
+        num_useful = 0
+        num_tracks = 0
+        num_tracks_free = 0
+
+        likes = self.api.user_likes(user_id, limit=self.max_user_likes)
+        async for like in likes:
+            if 'playlist' in like:
+                if like['playlist']['id'] not in self.visited_playlists \
+                        and like['playlist'].get('tracks'):
+                    num_useful += 1
+                self.add_candidate_playlist(like['playlist'])
+            if 'track' in like:
+                track_info = like['track']
+                if self.add_track(track_info):
+                    num_useful += 1
+                    num_tracks += 1
+                    if self.is_free(track_info['license']):
+                        num_tracks_free += 1
+
+            if num_useful >= self.max_useful_user_likes:
+                await likes.aclose()
+                break
+
+        return num_tracks, num_tracks_free
+
+    def get_scoring_snapshot(self):
+        """
+        Take a snapshot of the state that is needed by `score_and_choose_playlist`.
+
+        The snapshot is taken on the event loop, and nothing in it is modified afterwards, so it
+        can be scored in another thread while the event loop keeps modifying the state. Candidate
+        summaries are never modified in place, so we only need to copy the containers. Which of
+        their tracks are known is looked up here, since `self.tracks` and the track sketch must not
+        be read from the worker thread. The random generator for the choice is seeded here as
+        well, so that the choices do not depend on the timing of the worker thread.
+        """
+        # The below scoring code is pretty slow, and the number of candidate playlists grows over
+        # time. We can try to speed it up by sampling a random subset of candidates in each step.
+        candidates = random.sample(list(self.candidate_playlists.items()),
+                                   k=min(20000, len(self.candidate_playlists)))
+
+        # Look up whether the tracks are known for all candidates at once. `is_new` has an entry
+        # for each track of each candidate, and `known_complete` one for each complete track of
+        # each candidate, in order.
+        is_new = ~self.get_known_tracks([track_id
+                                         for _, candidate in candidates
+                                         for track_id in candidate['track_ids']])
+        known_complete = self.get_known_tracks([item[0]
+                                                for _, candidate in candidates
+                                                for item in candidate['complete']])
+
+        return (candidates,
+                is_new,
+                known_complete,
+                self.get_free_tracks_genre_distr(),
+                random.Random(random.getrandbits(64)))
 
     def choose_playlist(self):
         if not self.candidate_playlists:
             return None
 
+        playlist_id, self.top_candidates = \
+            self.score_and_choose_playlist(*self.get_scoring_snapshot())
+        return playlist_id
+
+    async def choose_playlist_async(self):
+        """
+        Choose a playlist like `choose_playlist`, but do the scoring in a worker thread, so that
+        the event loop can keep processing responses in the meantime.
+        """
+        if not self.candidate_playlists:
+            return None
+
+        snapshot = self.get_scoring_snapshot()
+        playlist_id, self.top_candidates = await asyncio.get_running_loop().run_in_executor(
+            self.scoring_executor, self.score_and_choose_playlist, *snapshot)
+
+        # The chosen playlist is usually, but not always, the best-scored one.
+        if playlist_id is not None:
+            self.prefetch_calls_left = self.prefetch_calls
+            self.start_prefetches(([playlist_id] + [candidate_id
+                                                    for candidate_id in self.top_candidates
+                                                    if candidate_id != playlist_id])
+                                  [:self.prefetch_top_k])
+        return playlist_id
+
+    def start_prefetches(self, playlist_ids):
+        """
+        Start prefetching the given candidate playlists, and drop the prefetches of playlists that
+        are no longer among them.
+        """
+        for playlist_id in list(self.prefetches):
+            if playlist_id not in playlist_ids:
+                self.drop_prefetch(playlist_id)
+
+        for playlist_id in playlist_ids:
+            if playlist_id in self.prefetches or playlist_id in self.visited_playlists:
+                continue
+            if self.prefetch_calls_left <= 0:
+                break
+            prefetch = {'calls': CallCounter()}
+            prefetch['task'] = asyncio.ensure_future(self.prefetch_playlist(playlist_id, prefetch))
+            self.prefetches[playlist_id] = prefetch
+            self.num_prefetches += 1
+
+    def drop_prefetch(self, playlist_id):
+        prefetch = self.prefetches.pop(playlist_id)
+        if not prefetch['task'].done():
+            prefetch['task'].cancel()
+        elif not prefetch['task'].cancelled():
+            # Retrieve the exception of a failed prefetch, so that asyncio does not complain.
+            prefetch['task'].exception()
+        self.num_wasted_prefetch_calls += prefetch['calls'].num_calls
+
+    async def prefetch_playlist(self, playlist_id, prefetch):
+        """
+        Fetch the details of a playlist and fill its incomplete track infos, as far as the prefetch
+        budget allows. Returns the playlist info and the (partially) filled track infos.
+
+        The budget is reserved before making the calls, but the calls that were actually made
+        (e.g. not coalesced with the calls of the current expansion) are counted by the API.
+        """
+        # This runs in its own task, so setting the counters does not affect any other task.
+        call_counters.set((prefetch['calls'], self.prefetch_call_counter))
+
+        self.prefetch_calls_left -= 1
+        playlist_info = await self.api.playlist(playlist_id)
+
+        track_infos = playlist_info['tracks'][:100]
+        incomplete = [i for i, track_info in enumerate(track_infos)
+                      if not self.is_complete_track_info(track_info)]
+        incomplete = incomplete[:max(self.prefetch_calls_left, 0)]
+        self.prefetch_calls_left -= len(incomplete)
+
+        filled = await asyncio.gather(*[self.api.track(track_infos[i]['id'])
+                                        for i in incomplete])
+        track_infos = list(track_infos)
+        for i, track_info in zip(incomplete, filled):
+            track_infos[i] = track_info
+
+        return playlist_info, track_infos
+
+    async def get_prefetched_playlist(self, playlist_id):
+        """
+        Take the prefetched data of the given playlist, waiting for the prefetch to finish if
+        needed. Returns `None` if the playlist was not prefetched or the prefetch failed.
+        """
+        prefetch = self.prefetches.pop(playlist_id, None)
+        if prefetch is None:
+            return None
+
+        try:
+            result = await prefetch['task']
+        except Exception as e:
+            print(f'    prefetch failed: {e}')
+            self.num_wasted_prefetch_calls += prefetch['calls'].num_calls
+            return None
+
+        self.num_prefetch_hits += 1
+        return result
+
+    def score_and_choose_playlist(self,
+                                  candidates,
+                                  is_new,
+                                  known_complete,
+                                  tracks_genre_distr,
+                                  rng):
+        """
+        Score the candidates of a snapshot taken by `get_scoring_snapshot`, and choose one of them.
+        Returns the chosen playlist ID and the IDs of the `prefetch_top_k` best-scored candidates.
+
+        This runs in the worker thread, so it must only use the snapshot, not the crawler state.
+        """
         print('genre_weights')
 
         # Note that, at this point, we only have genre information of five tracks per playlist (this
         # is the information that SoundCloud usually returns for playlist requests).
-        tracks_genre_distr = list(self.get_free_tracks_genre_distr().items())
+        tracks_genre_distr = list(tracks_genre_distr.items())
         tracks_genre_distr.sort(key=lambda item: item[1])
-        self.genre_weights = {genre: 0.85**(rank+1)
-                                     if genre not in IGNORE_GENRES and \
-                                        genre != 'others' and \
-                                        genre != 'unknown'
-                                     else 0.0
-                              for rank, (genre, _) in enumerate(tracks_genre_distr)}
-
-        print('candidates')
-
-        # The below scoring code is pretty slow, and the number of candidate playlists grows over
-        # time. We can try to speed it up by sampling a random subset of candidates in each step.
-        candidates = random.sample(list(self.candidate_playlists.items()),
-                                   k=20000)
+        genre_weights = {genre: 0.85**(rank+1)
+                                if genre not in IGNORE_GENRES and \
+                                   genre != 'others' and \
+                                   genre != 'unknown'
+                                else 0.0
+                         for rank, (genre, _) in enumerate(tracks_genre_distr)}
 
         print('scores')
 
+        # `new_track_counts[i]` is the number of new tracks in the first `i` candidates.
+        new_track_counts = np.concatenate([[0], np.cumsum(is_new)])
+        known_complete = known_complete.tolist()
+
         weights = []
+        start = 0
+        known_index = 0
         for _, candidate in candidates:
             track_values = []
-            new_tracks = 0
-
-            for track_info in candidate['tracks']:
-                if track_info['id'] not in self.tracks:
-                    new_tracks += 1
-
-                if self.is_complete_track_info(track_info):
-                    mapped_genre = map_genre(track_info['genre'])
-                    if mapped_genre == 'ignore':
-                        track_value = 0.0
-                    else:
-                        track_value = 1.0
-                        track_value *= 1.0 if self.is_free(track_info['license']) else 0.00005
-                        track_value *= 1.0 if self.is_track_okay(track_info) else 0.01
-                        track_value *= 1.0 if track_info['id'] not in self.tracks else 0.01
-                        track_value *= self.genre_weights.get(mapped_genre, 0.0)
-
-                    track_values.append(track_value)
+            end = start + len(candidate['track_ids'])
+            new_tracks = int(new_track_counts[end] - new_track_counts[start])
+            start = end
+
+            for _, code, is_free, is_okay in candidate['complete']:
+                is_known = known_complete[known_index]
+                known_index += 1
+
+                mapped_genre = GENRE_CODES[code]
+                if mapped_genre == 'ignore':
+                    track_value = 0.0
+                else:
+                    track_value = 1.0
+                    track_value *= 1.0 if is_free else 0.00005
+                    track_value *= 1.0 if is_okay else 0.01
+                    track_value *= 1.0 if not is_known else 0.01
+                    track_value *= genre_weights.get(mapped_genre, 0.0)
+
+                track_values.append(track_value)
 
             if len(track_values) == 0:
                 weights.append(0.0)
             else:
                 size_mult = 2/(1+math.exp(-new_tracks/20))-1
-                new_ratio = new_tracks / len(candidate['tracks'])
+                new_ratio = new_tracks / len(candidate['track_ids'])
                 mean_score = new_ratio * np.mean(track_values)
                 score = size_mult * mean_score
                 weights.append(math.exp(10000.0 * score))
@@ -403,20 +974,35 @@ class SoundCloudCrawler:
         #          f'{item[1]["freeness"]}\t'
         #          f'{self.calc_genre_novelty(item[1]["genre_distr"])}')
 
+        top_candidates = [item[0] for item, _ in candidates_weights[:self.prefetch_top_k]]
+
         print('sample')
 
-        choice_item, choice_weight = random.choices(candidates_weights, weights=weights)[0]
+        choice_item, choice_weight = rng.choices(candidates_weights, weights=weights)[0]
 
         print(f'    playlist_id: {choice_item[0]}, '
               f'weight: {choice_weight}')
 
-        return choice_item[0]
+        return choice_item[0], top_candidates
 
     async def crawl_step(self):
-        playlist_id = self.choose_playlist()
+        playlist_id = None
+        if self.next_choice is not None:
+            next_choice, self.next_choice = self.next_choice, None
+            playlist_id = await next_choice
+        if playlist_id is None:
+            # There was no choice in progress, or there were no candidates when it started.
+            playlist_id = await self.choose_playlist_async()
         if playlist_id is None:
             return False
-        del self.candidate_playlists[playlist_id]
+
+        # The candidate may have been evicted in the meantime.
+        self.candidate_playlists.pop(playlist_id, None)
+
+        # Choose the next playlist while this one is being expanded, so that the scoring overlaps
+        # with waiting for the API. The choice does not take the results of this step into
+        # account, which is a small price to pay.
+        self.next_choice = asyncio.ensure_future(self.choose_playlist_async())
 
         await self.visit_playlist(playlist_id)
 
@@ -427,17 +1013,25 @@ class SoundCloudCrawler:
                     print_info_steps=10,
                     save_steps=500,
                     save_path=None):
-        for step_num in range(max_steps):
-            try:
-                if save_path is not None and step_num > 0 and step_num % save_steps == 0:
-                    self.save_state(save_path)
-                if print_info_steps > 0 and step_num % print_info_steps == 0:
-                    self.print_info()
-
-                print(f'step {step_num}')
-                if not await self.crawl_step():
-                    return
-            except Exception as e:
-                print(f'Caught exception {e}')
-                traceback.print_exc()
+        try:
+            for step_num in range(max_steps):
+                try:
+                    if save_path is not None and step_num > 0 and step_num % save_steps == 0:
+                        self.save_state(save_path)
+                    if print_info_steps > 0 and step_num % print_info_steps == 0:
+                        self.print_info()
+
+                    print(f'step {step_num}')
+                    if not await self.crawl_step():
+                        return
+                except Exception as e:
+                    print(f'Caught exception {e}')
+                    traceback.print_exc()
+        finally:
+            # Don't leave the choice for a step that we are not going to take running.
+            if self.next_choice is not None:
+                self.next_choice.cancel()
+                self.next_choice = None
+            for playlist_id in list(self.prefetches):
+                self.drop_prefetch(playlist_id)
 
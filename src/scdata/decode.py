@@ -0,0 +1,160 @@
+"""
+Decoding of SoundCloud API responses.
+
+By default, responses are decoded into plain dictionaries, using `orjson` if it is installed. If
+`msgspec` is installed, there are also typed decoders for the endpoints that the crawler uses most.
+These skip over all the fields that the crawler does not look at, and they only materialize the
+full metadata of tracks that the crawler keeps around, i.e. free tracks (see
+`SoundCloudCrawler.strip_track_info`). The results are still plain dictionaries, so callers do not
+need to care which decoder has been used.
+"""
+
+import json
+from typing import List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    else:
+        return json.loads(bytes(data))
+
+
+def keeps_full_metadata(license) -> bool:
+    # Must agree with `SoundCloudCrawler.is_free`: only free tracks are stored with their full
+    # metadata. Incomplete track infos do not have a license, and they are small anyway. Tracks that
+    # are stored already and stop being free keep their metadata, since `add_track` merges the
+    # reduced info into the stored one.
+    return license != 'all-rights-reserved'
+
+
+if msgspec is not None:
+    UNSET = msgspec.UNSET
+
+    class Format(msgspec.Struct):
+        protocol: Union[Optional[str], msgspec.UnsetType] = UNSET
+
+    class Transcoding(msgspec.Struct):
+        url: Union[Optional[str], msgspec.UnsetType] = UNSET
+        format: Union[Format, msgspec.UnsetType] = UNSET
+
+    class Media(msgspec.Struct):
+        transcodings: Union[List[Transcoding], msgspec.UnsetType] = UNSET
+
+    class Track(msgspec.Struct):
+        # Only the fields that `SoundCloudCrawler` looks at. Fields that are missing in the
+        # response stay unset, so that `SoundCloudCrawler.is_complete_track_info` still works.
+        id: int
+        kind: Union[str, msgspec.UnsetType] = UNSET
+        artwork_url: Union[Optional[str], msgspec.UnsetType] = UNSET
+        license: Union[Optional[str], msgspec.UnsetType] = UNSET
+        likes_count: Union[Optional[int], msgspec.UnsetType] = UNSET
+        playback_count: Union[Optional[int], msgspec.UnsetType] = UNSET
+        title: Union[Optional[str], msgspec.UnsetType] = UNSET
+        genre: Union[Optional[str], msgspec.UnsetType] = UNSET
+        media: Union[Media, msgspec.UnsetType] = UNSET
+        downloadable: Union[Optional[bool], msgspec.UnsetType] = UNSET
+        has_downloads_left: Union[Optional[bool], msgspec.UnsetType] = UNSET
+
+    class Playlist(msgspec.Struct):
+        id: int
+        kind: Union[str, msgspec.UnsetType] = UNSET
+        tracks: List[msgspec.Raw] = []
+
+    class User(msgspec.Struct):
+        id: int
+        kind: Union[str, msgspec.UnsetType] = UNSET
+        username: Union[Optional[str], msgspec.UnsetType] = UNSET
+
+    class Like(msgspec.Struct):
+        track: Union[msgspec.Raw, msgspec.UnsetType] = UNSET
+        playlist: Union[msgspec.Raw, msgspec.UnsetType] = UNSET
+
+    class RawCollection(msgspec.Struct):
+        collection: List[msgspec.Raw]
+        next_href: Optional[str] = None
+
+    class UserCollection(msgspec.Struct):
+        collection: List[User]
+        next_href: Optional[str] = None
+
+    class LikeCollection(msgspec.Struct):
+        collection: List[Like]
+        next_href: Optional[str] = None
+
+    _track_decoder = msgspec.json.Decoder(Track)
+    _tracks_decoder = msgspec.json.Decoder(List[msgspec.Raw])
+    _playlist_decoder = msgspec.json.Decoder(Playlist)
+    _raw_collection_decoder = msgspec.json.Decoder(RawCollection)
+    _user_collection_decoder = msgspec.json.Decoder(UserCollection)
+    _like_collection_decoder = msgspec.json.Decoder(LikeCollection)
+
+    def decode_track(data):
+        track = _track_decoder.decode(data)
+        if keeps_full_metadata(track.license):
+            # `data` may be a `msgspec.Raw` slice of a larger response.
+            return loads(memoryview(data))
+        else:
+            return msgspec.to_builtins(track)
+
+    def decode_tracks(data):
+        return [decode_track(track) for track in _tracks_decoder.decode(data)]
+
+    def decode_playlist(data):
+        playlist = _playlist_decoder.decode(data)
+        result = {
+            'id': playlist.id,
+            'tracks': [decode_track(track) for track in playlist.tracks],
+        }
+        if playlist.kind is not UNSET:
+            result['kind'] = playlist.kind
+
+        return result
+
+    def decode_playlist_collection(data):
+        playlists = _raw_collection_decoder.decode(data)
+        return {
+            'collection': [decode_playlist(playlist) for playlist in playlists.collection],
+            'next_href': playlists.next_href,
+        }
+
+    def decode_user_collection(data):
+        return msgspec.to_builtins(_user_collection_decoder.decode(data))
+
+    def decode_like_collection(data):
+        likes = _like_collection_decoder.decode(data)
+        collection = []
+        for like in likes.collection:
+            item = {}
+            if like.track is not UNSET:
+                item['track'] = decode_track(like.track)
+            if like.playlist is not UNSET:
+                item['playlist'] = decode_playlist(like.playlist)
+            collection.append(item)
+
+        return {
+            'collection': collection,
+            'next_href': likes.next_href,
+        }
+
+    # Typed decoders by kind of response.
+    DECODERS = {
+        'track': decode_track,
+        'tracks': decode_tracks,
+        'playlist': decode_playlist,
+        'playlists': decode_playlist_collection,
+        'users': decode_user_collection,
+        'likes': decode_like_collection,
+    }
+else:
+    DECODERS = None
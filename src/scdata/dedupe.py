@@ -0,0 +1,231 @@
+"""
+Find groups of near-duplicate items, without comparing all pairs of items.
+
+For tracks that have not been downloaded yet, `find_metadata_duplicates` groups likely duplicates
+by their metadata.
+
+For audio, items are described by sets of tokens (e.g. the audio fingerprint tokens of `scdata.fingerprint`),
+and two items are similar if the Jaccard similarity of their sets is high. The sets are reduced to
+MinHash signatures, and a locality-sensitive hash (LSH) index over bands of the signatures yields
+the candidate pairs. Only those are compared, so that the cost grows with the number of items and
+the number of actual near-duplicates, rather than with the number of pairs.
+"""
+
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Mersenne prime for the universal hash functions of the MinHash permutations.
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+class MinHasher:
+    """
+    Compute MinHash signatures of sets of 32-bit tokens. For two sets, the fraction of equal
+    signature entries is an unbiased estimate of their Jaccard similarity.
+    """
+
+    def __init__(self, num_perm: int = 256, seed: int = 1):
+        rng = np.random.RandomState(seed)
+
+        # With `a < 2**31` and tokens below `2**32`, `a * token + b` does not overflow.
+        self.a = rng.randint(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    @property
+    def num_perm(self) -> int:
+        return len(self.a)
+
+    def signature(self, tokens: np.ndarray, block_size: int = 8192) -> np.ndarray:
+        signature = np.full(self.num_perm, np.iinfo(np.uint32).max, dtype=np.uint64)
+
+        tokens = np.asarray(tokens, dtype=np.uint64)
+        for start in range(0, len(tokens), block_size):
+            block = tokens[start:start + block_size, None]
+            hashes = (block * self.a + self.b) % MERSENNE_PRIME & np.uint64(0xFFFFFFFF)
+            signature = np.minimum(signature, hashes.min(axis=0))
+
+        return signature.astype(np.uint32)
+
+
+def estimate_similarity(signature_a: np.ndarray, signature_b: np.ndarray) -> float:
+    return float(np.mean(signature_a == signature_b))
+
+
+class LSHIndex:
+    """
+    Index of MinHash signatures, split into `num_bands` bands. Two signatures become a candidate
+    pair if they are equal in at least one band.
+
+    With `r` rows per band, sets with Jaccard similarity `s` become candidates with probability
+    `1 - (1 - s**r)**num_bands`. Fewer rows per band find more of the less similar pairs, at the
+    cost of more candidates.
+    """
+
+    def __init__(self, num_bands: int):
+        self.num_bands = num_bands
+        self.buckets = defaultdict(list)
+
+    def insert(self, key: Hashable, signature: np.ndarray):
+        assert len(signature) % self.num_bands == 0
+        for band, rows in enumerate(np.split(signature, self.num_bands)):
+            self.buckets[(band, rows.tobytes())].append(key)
+
+    def candidate_pairs(self, max_bucket_size: int = 1000) -> Iterable[Tuple[Hashable, Hashable]]:
+        """
+        Produce all distinct candidate pairs.
+
+        Buckets with more than `max_bucket_size` items are skipped. They are usually caused by
+        degenerate inputs (e.g. a lot of tracks that are mostly silence), and would make the
+        number of pairs quadratic again.
+        """
+        seen = set()
+        for keys in self.buckets.values():
+            if len(keys) < 2 or len(keys) > max_bucket_size:
+                continue
+            for i in range(len(keys)):
+                for j in range(i + 1, len(keys)):
+                    pair = (keys[i], keys[j])
+                    if pair not in seen:
+                        seen.add(pair)
+                        yield pair
+
+
+class UnionFind:
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, key: Hashable) -> Hashable:
+        root = self.parents.setdefault(key, key)
+        while self.parents[root] != root:
+            root = self.parents[root]
+
+        # Path compression.
+        while key != root:
+            parent = self.parents[key]
+            self.parents[key] = root
+            key = parent
+
+        return root
+
+    def union(self, key_a: Hashable, key_b: Hashable):
+        root_a = self.find(key_a)
+        root_b = self.find(key_b)
+        if root_a != root_b:
+            self.parents[root_b] = root_a
+
+    def groups(self) -> List[List[Hashable]]:
+        groups = defaultdict(list)
+        for key in self.parents:
+            groups[self.find(key)].append(key)
+        return list(groups.values())
+
+
+def find_near_duplicates(signatures: Dict[Hashable, np.ndarray],
+                         num_bands: int = 128,
+                         threshold: float = 0.05,
+                         max_bucket_size: int = 1000) -> Tuple[List[List[Hashable]], int]:
+    """
+    Group the items whose estimated similarity is at least `threshold`.
+
+    Similarity is not transitive, and grouping all items that are connected by similar pairs would
+    chain together unrelated items. Instead, like the anchors of `find_metadata_duplicates`, each
+    group has a representative, and all items of the group are similar to it. Two groups of a
+    similar pair are only merged if all items of the second one are similar to the representative
+    of the first one.
+
+    Items are inserted in the order of `signatures`, so the keys within each group are in the same
+    order. Every item ends up in exactly one group. Returns the groups and the number of candidate
+    pairs that were compared.
+    """
+    index = LSHIndex(num_bands)
+    clusters = UnionFind()
+    members = {}
+    for key, signature in signatures.items():
+        index.insert(key, signature)
+        clusters.find(key)
+        members[key] = [key]
+
+    def is_similar(key_a, key_b):
+        return estimate_similarity(signatures[key_a], signatures[key_b]) >= threshold
+
+    num_candidates = 0
+    for key_a, key_b in index.candidate_pairs(max_bucket_size):
+        num_candidates += 1
+        root_a = clusters.find(key_a)
+        root_b = clusters.find(key_b)
+        if root_a == root_b or not is_similar(key_a, key_b):
+            continue
+        if all(is_similar(root_a, key) for key in members[root_b]):
+            clusters.union(root_a, root_b)
+            members[root_a].extend(members.pop(root_b))
+
+    return clusters.groups(), num_candidates
+
+
+# Bracketed parts of titles that are often added or removed by re-uploads, e.g. "(Free Download)".
+TITLE_NOISE_PATTERN = re.compile(r'[(\[{][^)\]}]*\b(free|download|dl|out now|buy|premiere)\b'
+                                 r'[^)\]}]*[)\]}]')
+NON_WORD_PATTERN = re.compile(r'[\W_]+')
+
+
+def normalize_title(title: Optional[str]) -> str:
+    title = unicodedata.normalize('NFKC', title or '').casefold()
+    title = TITLE_NOISE_PATTERN.sub(' ', title)
+    return NON_WORD_PATTERN.sub(' ', title).strip()
+
+
+def find_metadata_duplicates(track_infos: Iterable[Dict],
+                             duration_tolerance: int = 2000,
+                             artwork_duration_tolerance: int = 10000) -> List[List[Dict]]:
+    """
+    Group tracks that are likely duplicates, based on their metadata only.
+
+    Only tracks with the same normalized title and uploader can be duplicates. Among those, tracks
+    are grouped in the order of their duration: a track joins the current group if its duration
+    differs by at most `duration_tolerance` milliseconds from the first track of the group (its
+    anchor), and starts a new group otherwise. Comparing against the anchor, rather than against the
+    previous track, keeps groups from chaining together tracks of very different durations.
+
+    The artwork is only a supporting signal. Different tracks of the same album usually share the
+    artwork, so on its own, it says little. But a track with the same title, uploader and artwork
+    as the anchor is a duplicate even if its duration differs by up to `artwork_duration_tolerance`
+    milliseconds, e.g. if silence was trimmed.
+
+    Every track ends up in exactly one group.
+    """
+    def get_duration(track_info):
+        return track_info.get('duration') or 0
+
+    track_infos = {track_info['id']: track_info for track_info in track_infos}
+
+    index = defaultdict(list)
+    groups = []
+    for track_info in track_infos.values():
+        title = normalize_title(track_info.get('title'))
+        if title:
+            index[(title, track_info.get('user_id'))].append(track_info)
+        else:
+            groups.append([track_info])
+
+    for candidates in index.values():
+        candidates.sort(key=get_duration)
+        group = [candidates[0]]
+        for track_info in candidates[1:]:
+            anchor = group[0]
+            tolerance = duration_tolerance
+            if track_info.get('artwork_url') and \
+                    track_info.get('artwork_url') == anchor.get('artwork_url'):
+                tolerance = artwork_duration_tolerance
+
+            if get_duration(track_info) - get_duration(anchor) <= tolerance:
+                group.append(track_info)
+            else:
+                groups.append(group)
+                group = [track_info]
+        groups.append(group)
+
+    return groups
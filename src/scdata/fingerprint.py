@@ -0,0 +1,117 @@
+"""
+Compact spectral fingerprints of audio files, for finding near-duplicate tracks.
+
+The audio is decoded to mono PCM at a low sample rate with `ffmpeg` (which needs to be installed).
+For each frame, the energies of 17 logarithmically spaced bands between 300 and 2000 Hz are
+compared, giving a 16-bit sub-fingerprint per frame, similar to Haitsma and Kalker, "A Highly
+Robust Audio Fingerprinting System". Unlike a checksum of the file, the sub-fingerprints survive
+re-encoding with a different bitrate, changed tags and trimmed silence.
+
+A track is then described by the set of its tokens, each of which combines two sub-fingerprints
+some frames apart. Re-encoded copies of a track share a good part of their tokens, while unrelated
+tracks share almost none. See `scdata.dedupe` for comparing the token sets.
+"""
+
+import subprocess
+
+import numpy as np
+
+SAMPLE_RATE = 5512
+FRAME_SIZE = 2048
+HOP_SIZE = 256
+NUM_BANDS = 17
+MIN_FREQ = 300.0
+MAX_FREQ = 2000.0
+
+# Band energies are averaged over this many frames (about 0.4 seconds), which makes the bits a lot
+# more robust against encoding noise.
+SMOOTH_FRAMES = 8
+
+# Each token combines the sub-fingerprints of two frames that are this many frames apart.
+TOKEN_LAG = 8
+
+
+def decode_audio(path: str, sample_rate: int = SAMPLE_RATE, max_duration: float = 900.0):
+    """
+    Decode (at most the first `max_duration` seconds of) an audio file to mono float samples.
+    """
+    command = ['ffmpeg', '-v', 'error', '-nostdin',
+               '-i', path,
+               '-t', str(max_duration),
+               '-ac', '1',
+               '-ar', str(sample_rate),
+               '-f', 's16le', '-']
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+    return np.frombuffer(result.stdout, dtype='<i2').astype(np.float32) / 32768.0
+
+
+def get_band_energies(samples: np.ndarray, block_size: int = 4096):
+    """
+    Compute the energies of the fingerprint bands for each frame. Returns an array of shape
+    `(num_frames, NUM_BANDS)`.
+    """
+    if len(samples) < FRAME_SIZE:
+        return np.zeros((0, NUM_BANDS), dtype=np.float32)
+
+    edges = np.geomspace(MIN_FREQ, MAX_FREQ, NUM_BANDS + 1)
+    bins = np.round(edges * FRAME_SIZE / SAMPLE_RATE).astype(int)
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+
+    # Go through the frames in blocks, so that long mixes do not need gigabytes for the spectrum.
+    energies = []
+    for start in range(0, len(frames), block_size):
+        spectrum = np.abs(np.fft.rfft(frames[start:start + block_size] * window, axis=1))**2
+        spectrum = np.cumsum(spectrum, axis=1)
+        energies.append(spectrum[:, bins[1:] - 1] - spectrum[:, bins[:-1] - 1])
+
+    return np.concatenate(energies).astype(np.float32)
+
+
+def compute_fingerprint(samples: np.ndarray):
+    """
+    Compute the sub-fingerprints of the given samples.
+
+    Returns an array with one 16-bit sub-fingerprint per (smoothed) frame, and a boolean array
+    that tells which of the frames are not silent.
+    """
+    energies = get_band_energies(samples)
+    if len(energies) < 2 * SMOOTH_FRAMES:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+
+    kernel = np.ones(SMOOTH_FRAMES, dtype=np.float32) / SMOOTH_FRAMES
+    energies = np.stack([np.convolve(energies[:, band], kernel, mode='valid')
+                         for band in range(NUM_BANDS)], axis=1)
+
+    # The bits of silent frames are arbitrary, we don't want to match on them.
+    total = energies.sum(axis=1)
+    loud = total > 1e-3 * np.median(total) + 1e-9
+
+    # Bit m of frame n is set if the energy difference between bands m and m + 1 increased
+    # compared to the previous (non-overlapping) smoothed frame.
+    log_energies = np.log(energies + 1e-9)
+    band_diffs = log_energies[:, :-1] - log_energies[:, 1:]
+    bits = band_diffs[SMOOTH_FRAMES:] > band_diffs[:-SMOOTH_FRAMES]
+
+    fingerprint = (bits * (1 << np.arange(NUM_BANDS - 1, dtype=np.uint32))).sum(axis=1)
+    return fingerprint.astype(np.uint32), loud[SMOOTH_FRAMES:] & loud[:-SMOOTH_FRAMES]
+
+
+def get_tokens(fingerprint: np.ndarray, loud: np.ndarray):
+    """
+    Combine pairs of sub-fingerprints into the set of 32-bit tokens that describes a track.
+    """
+    if len(fingerprint) <= TOKEN_LAG:
+        return np.zeros(0, dtype=np.uint32)
+
+    tokens = fingerprint[:-TOKEN_LAG] | (fingerprint[TOKEN_LAG:] << np.uint32(16))
+    tokens = tokens[loud[:-TOKEN_LAG] & loud[TOKEN_LAG:]]
+    return np.unique(tokens)
+
+
+def fingerprint_file(path: str):
+    """
+    Decode an audio file and return its token set.
+    """
+    return get_tokens(*compute_fingerprint(decode_audio(path)))
@@ -131,6 +131,11 @@ GENRES = set([
     'world',
 ])
 
+# Compact integer codes for the mapped genres, including the special values returned by
+# `map_genre`. Used for storing the genres of many tracks, e.g. in candidate playlists.
+GENRE_CODES = sorted(GENRES) + ['others', 'ignore', 'unknown']
+GENRE_CODE_MAP = {genre: code for code, genre in enumerate(GENRE_CODES)}
+
 
 def normalize_distr(weights: Dict[str, float]):
     total = sum(weights.values()) 
@@ -183,6 +188,10 @@ def map_genre(genre):
         return genre if genre in GENRES else 'others'
 
 
+def genre_code(genre):
+    return GENRE_CODE_MAP[map_genre(genre)]
+
+
 def genre_distr(genres):
     genres = Counter(map_genre(genre) for genre in genres)
     return normalize_distr(genres)
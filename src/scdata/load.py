@@ -1,4 +1,50 @@
+import hashlib
+import json
 import os
 
-def get_audio_path(audio_dir, track_id):
-    return os.path.join(audio_dir, str(track_id)[:3], str(track_id) + '.mp3')
+# The layout of an audio directory is recorded in a marker file in the directory. Without it, the
+# original layout (version 1) is assumed.
+#
+# Version 1 shards by the first three digits of the track ID. SoundCloud IDs are roughly
+# sequential, so most tracks of a crawl end up in a handful of directories with thousands of files
+# each. Version 2 shards by a hash of the track ID, into two levels of 256 directories each.
+LAYOUT_FILE = '.scdata_layout.json'
+LAYOUT_VERSIONS = [1, 2]
+
+_layout_versions = {}
+
+
+def get_layout_version(audio_dir):
+    version = _layout_versions.get(audio_dir)
+    if version is None:
+        path = os.path.join(audio_dir, LAYOUT_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                version = json.load(f)['version']
+        else:
+            version = 1
+        _layout_versions[audio_dir] = version
+
+    return version
+
+
+def set_layout_version(audio_dir, version):
+    assert version in LAYOUT_VERSIONS
+
+    os.makedirs(audio_dir, exist_ok=True)
+    with open(os.path.join(audio_dir, LAYOUT_FILE), 'w') as f:
+        json.dump({'version': version}, f)
+    _layout_versions[audio_dir] = version
+
+
+def get_audio_path(audio_dir, track_id, layout_version=None, ext='.mp3'):
+    if layout_version is None:
+        layout_version = get_layout_version(audio_dir)
+
+    if layout_version == 1:
+        return os.path.join(audio_dir, str(track_id)[:3], str(track_id) + ext)
+    elif layout_version == 2:
+        digest = hashlib.md5(str(track_id).encode('utf-8')).hexdigest()
+        return os.path.join(audio_dir, digest[:2], digest[2:4], str(track_id) + ext)
+    else:
+        raise ValueError(f'Unknown audio directory layout version {layout_version}')
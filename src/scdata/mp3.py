@@ -0,0 +1,238 @@
+"""
+Validate MP3 files by walking their MPEG frame headers, without decoding any audio.
+
+This gives the actual duration, the average bitrate and the number of frames of a file, and it
+detects truncated downloads, for which the last frame extends beyond the end of the file. Scanning
+a file costs little more than reading it.
+"""
+
+import json
+import os
+from multiprocessing import Pool
+from typing import Dict, Iterable, Optional
+
+# Bitrates in kbit/s, by (MPEG version 1 or 2, layer).
+BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Sample rates in Hz, by MPEG version (2.5 is stored as 3).
+SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    3: [11025, 12000, 8000],
+}
+
+# Version and layer bits of the frame header.
+VERSIONS = {0b00: 3, 0b10: 2, 0b11: 1}
+LAYERS = {0b01: 3, 0b10: 2, 0b11: 1}
+
+
+def parse_frame_header(data: bytes, offset: int):
+    """
+    Parse the MPEG audio frame header at the given offset.
+
+    Returns a tuple `(frame_length, num_samples, sample_rate)`, or `None` if there is no valid
+    header at the offset.
+    """
+    if offset + 4 > len(data):
+        return None
+
+    b0, b1, b2 = data[offset], data[offset + 1], data[offset + 2]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version = VERSIONS.get((b1 >> 3) & 0b11)
+    layer = LAYERS.get((b1 >> 1) & 0b11)
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0b11
+    padding = (b2 >> 1) & 0b1
+
+    # Free-format bitrates (index 0) are not supported.
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = BITRATES[(min(version, 2), layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+
+    if layer == 1:
+        num_samples = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or version == 1:
+        num_samples = 1152
+        frame_length = 144 * bitrate // sample_rate + padding
+    else:
+        num_samples = 576
+        frame_length = 72 * bitrate // sample_rate + padding
+
+    return frame_length, num_samples, sample_rate
+
+
+def get_id3v2_size(data: bytes) -> int:
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+
+    # The tag size is a 28-bit "syncsafe" integer, excluding the header and the optional footer.
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    has_footer = data[5] & 0x10
+    return 10 + size + (10 if has_footer else 0)
+
+
+def get_audio_end(data: bytes) -> int:
+    end = len(data)
+
+    # ID3v1 tag (`tags.save(v1=2)` in `SoundCloudAPI.save_track` writes one).
+    if end >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+
+    # APEv2 tag, identified by its footer.
+    if end >= 32 and data[end - 32:end - 24] == b'APETAGEX':
+        size = int.from_bytes(data[end - 20:end - 16], 'little')
+        has_header = data[end - 9] & 0x80
+        end -= size + (32 if has_header else 0)
+
+    return max(end, 0)
+
+
+def scan_mp3_data(data: bytes) -> Dict:
+    offset = get_id3v2_size(data)
+    end = get_audio_end(data)
+
+    num_frames = 0
+    num_samples = 0
+    num_audio_bytes = 0
+    num_junk_bytes = 0
+    sample_rate = None
+    truncated = False
+
+    while offset + 4 <= end:
+        header = parse_frame_header(data, offset)
+
+        if header is not None and sample_rate is not None and header[2] != sample_rate:
+            # All frames of a stream have the same sample rate. This is likely a false sync.
+            header = None
+
+        if header is None:
+            # Resynchronize on the next frame header. To avoid false syncs within junk data,
+            # require that it is followed by another frame header.
+            next_offset = data.find(b'\xff', offset + 1, end)
+            while next_offset != -1:
+                candidate = parse_frame_header(data, next_offset)
+                if candidate is not None \
+                        and (next_offset + candidate[0] == end
+                             or parse_frame_header(data, next_offset + candidate[0]) is not None):
+                    break
+                next_offset = data.find(b'\xff', next_offset + 1, end)
+
+            if next_offset == -1:
+                num_junk_bytes += end - offset
+                break
+
+            num_junk_bytes += next_offset - offset
+            offset = next_offset
+            continue
+
+        frame_length, frame_samples, frame_sample_rate = header
+        if offset + frame_length > end:
+            truncated = True
+            break
+
+        # The first frame may be a Xing/Info or VBRI header written by the encoder, which does
+        # not contain audio.
+        is_info_frame = num_frames == 0 and any(tag in data[offset:offset + min(frame_length, 64)]
+                                                for tag in (b'Xing', b'Info', b'VBRI'))
+
+        if not is_info_frame:
+            num_frames += 1
+            num_samples += frame_samples
+            num_audio_bytes += frame_length
+        sample_rate = frame_sample_rate
+        offset += frame_length
+
+    duration = num_samples / sample_rate if sample_rate else 0.0
+
+    return {
+        'num_frames': num_frames,
+        'duration': int(duration * 1000),
+        'bitrate': round(num_audio_bytes * 8 / duration / 1000) if duration > 0 else 0,
+        'sample_rate': sample_rate,
+        'num_junk_bytes': num_junk_bytes,
+        'truncated': truncated,
+    }
+
+
+def scan_mp3(path: str) -> Dict:
+    """
+    Scan the frames of the given MP3 file.
+
+    Returns a dictionary with the number of audio frames, the duration in milliseconds (same unit
+    as the `duration` returned by the SoundCloud API), the average bitrate in kbit/s, the sample
+    rate, the number of bytes that are not part of any frame, and whether the last frame is
+    truncated.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    return scan_mp3_data(data)
+
+
+def is_mp3_okay(scan: Dict) -> bool:
+    return 'error' not in scan and scan['num_frames'] > 0 and not scan['truncated']
+
+
+def _scan_mp3_job(path):
+    try:
+        return path, scan_mp3(path)
+    except OSError as e:
+        return path, {'error': str(e)}
+
+
+def scan_mp3_files(paths: Iterable[str],
+                   cache_path: Optional[str] = None,
+                   processes: Optional[int] = None) -> Dict[str, Dict]:
+    """
+    Scan many MP3 files in a process pool.
+
+    Results are cached in the given JSON file, together with the size and modification time of
+    each file, so that only new or changed files are scanned again.
+    """
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    results = {}
+    missing = []
+    for path in paths:
+        stat = os.stat(path)
+        entry = cache.get(path)
+        if entry is not None and entry['size'] == stat.st_size \
+                and entry['mtime_ns'] == stat.st_mtime_ns:
+            results[path] = entry['scan']
+        else:
+            missing.append((path, stat))
+
+    if missing:
+        stats = dict(missing)
+        with Pool(processes) as pool:
+            for path, scan in pool.imap_unordered(_scan_mp3_job, stats.keys(), chunksize=16):
+                results[path] = scan
+                if 'error' not in scan:
+                    cache[path] = {
+                        'size': stats[path].st_size,
+                        'mtime_ns': stats[path].st_mtime_ns,
+                        'scan': scan,
+                    }
+
+        if cache_path is not None:
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+
+    return results
@@ -0,0 +1,187 @@
+"""
+Compact replacements for collections of tracks that we only need for statistics.
+
+The crawler keeps the metadata of all free tracks, but for non-free tracks, it only needs to know
+whether a track has been seen before, and how many tracks there are per license and genre. A
+`TrackSketch` stores exactly that: the counters, and a Bloom filter of the track IDs.
+"""
+
+import base64
+import math
+import random
+import zlib
+from collections import Counter
+from typing import Dict
+
+import numpy as np
+
+# Multiplier for Fibonacci hashing of the keys. Track IDs are not adversarial, so this mixes well
+# enough.
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class BloomFilter:
+    """
+    Set of integer keys with false positives, but without false negatives. With `capacity` keys,
+    the false positive rate is about `error_rate`; beyond that, it degrades gradually.
+
+    Lookups are on the hot path of the crawler (see `SoundCloudCrawler.get_known_tracks`), so this
+    is a blocked Bloom filter with precomputed bit patterns, see Putze et al., "Cache-, Hash- and
+    Space-Efficient Bloom Filters": a key only touches a single 64-bit word, and the bits it sets in
+    that word are one of `num_patterns` random patterns. This way, a lookup is a multiplicative hash,
+    two array lookups and a mask test, which can be vectorized with numpy (see `contains_many`).
+    Since the bits of a key are not independent, this needs more bits for the same error rate than
+    a standard Bloom filter.
+    """
+
+    # Extra space that the blocked filter needs to reach the error rate of a standard one.
+    SPACE_OVERHEAD = 1.3
+
+    def __init__(self,
+                 capacity: int = 4000000,
+                 error_rate: float = 0.01,
+                 num_patterns: int = 1 << 16,
+                 seed: int = 1):
+        assert num_patterns & (num_patterns - 1) == 0
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.seed = seed
+
+        num_bits = -capacity * math.log(error_rate) / math.log(2)**2 * self.SPACE_OVERHEAD
+        self.num_words = max(1, int(math.ceil(num_bits / 64)))
+        self.num_hashes = max(1, int(round(-math.log(error_rate) / math.log(2))))
+        self.words = np.zeros(self.num_words, dtype=np.uint64)
+
+        rng = random.Random(seed)
+        self.pattern_mask = num_patterns - 1
+        self.pattern_list = [sum(1 << bit for bit in rng.sample(range(64), self.num_hashes))
+                             for _ in range(num_patterns)]
+        self.patterns = np.array(self.pattern_list, dtype=np.uint64)
+
+    @property
+    def num_bits(self) -> int:
+        return 64 * self.num_words
+
+    def get_word_and_pattern(self, key: int):
+        # Python integers are faster than numpy scalars for single lookups.
+        h = (int(key) * HASH_MULTIPLIER) & 0xFFFFFFFFFFFFFFFF
+        return (h >> 16) % self.num_words, self.pattern_list[h & self.pattern_mask]
+
+    def add(self, key: int):
+        index, pattern = self.get_word_and_pattern(key)
+        self.words[index] = self.words.item(index) | pattern
+
+    def __contains__(self, key: int) -> bool:
+        index, pattern = self.get_word_and_pattern(key)
+        return self.words.item(index) & pattern == pattern
+
+    def contains_many(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Vectorized membership test. Returns a boolean array.
+        """
+        # Multiplying unsigned 64-bit integers wraps around, like the masking in the scalar version.
+        h = np.asarray(keys).astype(np.uint64) * np.uint64(HASH_MULTIPLIER)
+        patterns = self.patterns[h & np.uint64(self.pattern_mask)]
+        words = self.words[(h >> np.uint64(16)) % np.uint64(self.num_words)]
+        return words & patterns == patterns
+
+    def estimate_size(self) -> float:
+        """
+        Estimate the number of distinct keys from the number of set bits, see Swamidass and Baldi,
+        "Mathematical Correction for Fingerprint Similarity Measures". For the blocked filter, this
+        is a slight underestimate.
+        """
+        num_set = int(np.unpackbits(self.words.view(np.uint8)).sum())
+        if num_set >= self.num_bits:
+            return float('inf')
+        return -self.num_bits / self.num_hashes * math.log(1 - num_set / self.num_bits)
+
+    def update(self, other: 'BloomFilter'):
+        """
+        Add all keys of another filter with the same parameters.
+        """
+        assert (self.num_words, self.num_hashes, self.seed, len(self.patterns)) \
+            == (other.num_words, other.num_hashes, other.seed, len(other.patterns))
+        self.words |= other.words
+
+    def state_dict(self) -> Dict:
+        words = self.words.astype('<u8').tobytes()
+        return {
+            'capacity': self.capacity,
+            'error_rate': self.error_rate,
+            'num_patterns': len(self.patterns),
+            'seed': self.seed,
+            'words': base64.b64encode(zlib.compress(words)).decode('ascii'),
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: Dict) -> 'BloomFilter':
+        if 'words' not in state:
+            raise ValueError('Bloom filters of older versions are not supported')
+
+        bloom_filter = cls(state['capacity'],
+                           state['error_rate'],
+                           num_patterns=state['num_patterns'],
+                           seed=state['seed'])
+        words = np.frombuffer(zlib.decompress(base64.b64decode(state['words'])), dtype='<u8')
+        assert len(words) == bloom_filter.num_words
+        bloom_filter.words = words.astype(np.uint64)
+        return bloom_filter
+
+
+class TrackSketch:
+    """
+    Statistics of tracks that are not stored individually: the number of distinct tracks, counts per
+    license and per (raw) genre, and a Bloom filter for checking whether a track has been seen.
+
+    Due to false positives of the filter, a small fraction of new tracks is mistaken for known
+    tracks, so the counts are slight underestimates. Tracks cannot be removed, so a track that is
+    stored individually later on (e.g. because it became free) is still counted here, see
+    `SoundCloudCrawler.get_sketch_counts`.
+    """
+
+    def __init__(self, capacity: int = 4000000, error_rate: float = 0.01):
+        self.seen = BloomFilter(capacity, error_rate)
+        self.num_tracks = 0
+        self.licenses = Counter()
+        self.genres = Counter()
+
+    def add(self, track_info) -> bool:
+        """
+        Count the given track, unless it has been seen before. Returns whether it was new.
+        """
+        if track_info['id'] in self.seen:
+            return False
+
+        self.seen.add(track_info['id'])
+        self.num_tracks += 1
+        self.licenses[track_info.get('license')] += 1
+        self.genres[track_info.get('genre')] += 1
+        return True
+
+    def __contains__(self, track_id: int) -> bool:
+        return track_id in self.seen
+
+    def contains_many(self, track_ids: np.ndarray) -> np.ndarray:
+        return self.seen.contains_many(track_ids)
+
+    def __len__(self) -> int:
+        return self.num_tracks
+
+    def state_dict(self) -> Dict:
+        # JSON object keys must be strings, but licenses and genres can be `None`.
+        return {
+            'seen': self.seen.state_dict(),
+            'num_tracks': self.num_tracks,
+            'licenses': list(self.licenses.items()),
+            'genres': list(self.genres.items()),
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: Dict) -> 'TrackSketch':
+        sketch = cls(capacity=1)
+        sketch.seen = BloomFilter.from_state_dict(state['seen'])
+        sketch.num_tracks = state['num_tracks']
+        sketch.licenses = Counter(dict(state['licenses']))
+        sketch.genres = Counter(dict(state['genres']))
+        return sketch
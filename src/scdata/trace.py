@@ -0,0 +1,143 @@
+"""
+Record and replay traces of SoundCloud API responses.
+
+A trace consists of two files: the data file, which is a sequence of records, and an index file
+next to it (with the suffix `.idx`), which has one JSON line `[key, offset]` per record. Each record
+is a header with the lengths of the key and of the zlib-compressed response, followed by the key
+and the compressed response. Keys identify a request by its resource and arguments, without the
+client ID. If the same key has been recorded multiple times, the last response wins.
+
+Replaying only makes sense from the crawler state that the recording started from, so that state is
+stored next to the trace as well (with the suffix `.state.json`).
+
+In replay mode, the whole data file is read into memory, so that responses can be served quickly.
+This allows evaluating changes to the crawler (e.g. the playlist score) offline, on identical data.
+"""
+
+import json
+import os
+import struct
+import zlib
+
+HEADER = struct.Struct('<II')
+
+
+class TraceMissError(KeyError):
+    pass
+
+
+def get_initial_state_path(path: str) -> str:
+    return path + '.state.json'
+
+
+class Trace:
+    def __init__(self, path: str, mode: str = 'replay', compression_level: int = 6):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Invalid trace mode "{mode}"')
+
+        self.path = path
+        self.index_path = path + '.idx'
+        self.initial_state_path = get_initial_state_path(path)
+        self.mode = mode
+        self.compression_level = compression_level
+
+        self.index = {}
+        if os.path.exists(self.path):
+            self.load_index()
+
+        if mode == 'record':
+            self.data_file = open(self.path, 'ab')
+            self.index_file = open(self.index_path, 'a')
+        else:
+            with open(self.path, 'rb') as f:
+                self.data = f.read()
+
+    def load_index(self):
+        rebuild = not os.path.exists(self.index_path)
+        if not rebuild:
+            try:
+                with open(self.index_path) as f:
+                    for line in f:
+                        key, offset = json.loads(line)
+                        self.index[key] = offset
+            except ValueError:
+                # The last line may be incomplete if the recording process was killed.
+                rebuild = True
+                self.index = {}
+
+        # Records may also have been written without updating the index. Recover them by scanning
+        # the data file after the last indexed record.
+        size = os.path.getsize(self.path)
+        recovered = []
+        with open(self.path, 'rb') as f:
+            end = 0
+            if self.index:
+                end = max(self.index.values())
+                f.seek(end)
+                key_len, data_len = HEADER.unpack(f.read(HEADER.size))
+                end += HEADER.size + key_len + data_len
+
+            while end + HEADER.size <= size:
+                f.seek(end)
+                key_len, data_len = HEADER.unpack(f.read(HEADER.size))
+                if end + HEADER.size + key_len + data_len > size:
+                    break
+
+                recovered.append((f.read(key_len).decode('utf-8'), end))
+                end += HEADER.size + key_len + data_len
+
+        for key, offset in recovered:
+            self.index[key] = offset
+
+        if rebuild:
+            with open(self.index_path, 'w') as f:
+                for key, offset in sorted(self.index.items(), key=lambda item: item[1]):
+                    f.write(json.dumps([key, offset]) + '\n')
+        elif recovered:
+            with open(self.index_path, 'a') as f:
+                for key, offset in recovered:
+                    f.write(json.dumps([key, offset]) + '\n')
+
+        # Drop a truncated record at the end, so that new records are appended after the last
+        # complete one.
+        if end < size and self.mode == 'record':
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key: str):
+        return key in self.index
+
+    def record(self, key: str, data: bytes):
+        assert self.mode == 'record'
+
+        key_bytes = key.encode('utf-8')
+        compressed = zlib.compress(data, self.compression_level)
+
+        offset = self.data_file.tell()
+        self.data_file.write(HEADER.pack(len(key_bytes), len(compressed)))
+        self.data_file.write(key_bytes)
+        self.data_file.write(compressed)
+        self.data_file.flush()
+
+        self.index[key] = offset
+        self.index_file.write(json.dumps([key, offset]) + '\n')
+        self.index_file.flush()
+
+    def lookup(self, key: str) -> bytes:
+        assert self.mode == 'replay'
+
+        offset = self.index.get(key)
+        if offset is None:
+            raise TraceMissError(key)
+
+        key_len, data_len = HEADER.unpack_from(self.data, offset)
+        start = offset + HEADER.size + key_len
+        return zlib.decompress(self.data[start:start + data_len])
+
+    def close(self):
+        if self.mode == 'record':
+            self.data_file.close()
+            self.index_file.close()
@@ -0,0 +1,14 @@
+import importlib.util
+import os
+
+TOOLS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools')
+
+
+def load_tool(name):
+    """
+    Import one of the scripts in `tools/` as a module.
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(TOOLS_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,140 @@
+import asyncio
+import json
+
+import pytest
+
+from scdata import SoundCloudCrawler, decode
+
+from test_finalize import make_track_info
+
+
+def decode_track(track_info):
+    # The crawl tools use the typed decoders if msgspec is installed. These drop most fields of
+    # non-free tracks.
+    data = json.dumps(track_info).encode('utf-8')
+    if decode.DECODERS is not None:
+        return decode.DECODERS['track'](data)
+    return {key: value for key, value in track_info.items()
+            if key in ['id', 'license', 'genre', 'likes_count', 'playback_count', 'title',
+                       'artwork_url', 'media', 'downloadable', 'has_downloads_left']}
+
+
+class PlaylistAPI:
+    """
+    Serves a single playlist, and nothing to expand it with.
+    """
+
+    def __init__(self, playlist_info):
+        self.playlist_info = playlist_info
+
+    async def playlist(self, playlist_id):
+        return self.playlist_info
+
+    async def nothing(self, *args, **kwargs):
+        return
+        yield
+
+    track_playlists = nothing
+    playlist_likers = nothing
+
+    def get_num_calls(self):
+        return 0
+
+
+def test_license_change_keeps_metadata():
+    for sketch_non_free_tracks in [False, True]:
+        crawler = SoundCloudCrawler(api=None, sketch_non_free_tracks=sketch_non_free_tracks)
+        crawler.min_track_likes = 0
+        crawler.min_track_plays = 0
+        track_info = dict(make_track_info(1), user={'id': 2, 'username': 'user'})
+        assert crawler.add_track(decode_track(track_info))
+        assert crawler.tracks[1]['user'] == {'id': 2, 'username': 'user'}
+
+        track_info['license'] = 'all-rights-reserved'
+        track_info['likes_count'] = 20
+        assert crawler.add_track(decode_track(track_info))
+
+        stored_info = crawler.tracks[1]
+        assert stored_info['license'] == 'all-rights-reserved'
+        assert stored_info['likes_count'] == 20
+        assert stored_info['duration'] == 60000
+        assert stored_info['user'] == {'id': 2, 'username': 'user'}
+        assert 'scdata_license_changed_at' in stored_info
+        assert not crawler.is_track_complete(stored_info)
+
+        # Free again.
+        track_info['license'] = 'cc-by'
+        assert crawler.add_track(decode_track(track_info))
+        assert 'scdata_license_changed_at' not in crawler.tracks[1]
+        assert crawler.is_track_complete(crawler.tracks[1])
+
+        # Tracks that have never been free are still stripped.
+        assert crawler.add_track(decode_track(dict(make_track_info(3),
+                                                   license='all-rights-reserved')))
+        assert 'duration' not in crawler.tracks.get(3, {})
+
+
+def test_free_genre_counts():
+    for sketch_non_free_tracks in [False, True]:
+        crawler = SoundCloudCrawler(api=None, sketch_non_free_tracks=sketch_non_free_tracks)
+        crawler.min_track_likes = 0
+        crawler.min_track_plays = 0
+        crawler.add_track(make_track_info(1))
+        crawler.add_track(dict(make_track_info(2), genre='Jazz'))
+        crawler.add_track(dict(make_track_info(3), genre='Jazz', license='all-rights-reserved'))
+        assert crawler.get_free_tracks_genre_distr() == {'techno': 0.5,
+                                                       'jazz & blues': 0.5,
+                                                       'others': 0.0}
+
+        # Not free anymore, and free again.
+        crawler.add_track(dict(make_track_info(2), genre='Jazz', license='all-rights-reserved'))
+        assert crawler.get_free_tracks_genre_distr() == {'techno': 1.0, 'others': 0.0}
+        crawler.add_track(dict(make_track_info(2), genre='Rock'))
+        assert crawler.get_free_tracks_genre_distr() == {'techno': 0.5,
+                                                       'rock': 0.5,
+                                                       'others': 0.0}
+
+
+def test_sketch_false_positive_keeps_new_track():
+    track_info = make_track_info(1)
+    crawler = SoundCloudCrawler(api=PlaylistAPI({'id': 10, 'tracks': [track_info]}),
+                                sketch_non_free_tracks=True)
+    crawler.min_track_likes = 0
+    crawler.min_track_plays = 0
+    # Pretend that the new track is a false positive of the sketch.
+    crawler.track_sketch.seen.add(1)
+    assert crawler.is_known_track(1)
+
+    asyncio.run(crawler.visit_playlist(10))
+    assert 1 in crawler.tracks
+
+
+def test_sketched_tracks_are_counted_once():
+    crawler = SoundCloudCrawler(api=None, sketch_non_free_tracks=True)
+    crawler.min_track_likes = 0
+    crawler.min_track_plays = 0
+    crawler.add_track(dict(make_track_info(1), license='all-rights-reserved'))
+    crawler.add_track(dict(make_track_info(2), license='all-rights-reserved'))
+    # Became free.
+    crawler.add_track(make_track_info(2))
+
+    num_sketched, licenses, genres = crawler.get_sketch_counts()
+    assert num_sketched == 1
+    assert licenses == {'all-rights-reserved': 1}
+    assert genres == {'Techno': 1}
+
+
+def test_failed_expansion_is_charged():
+    class FailingAPI:
+        num_calls = 0
+
+        def get_num_calls(self):
+            return self.num_calls
+
+    crawler = SoundCloudCrawler(api=FailingAPI())
+    calls = crawler.fanout_budget.calls['user_likes']
+    with pytest.raises(RuntimeError):
+        with crawler.measure_expansion('user_likes', 2):
+            crawler.api.num_calls += 5
+            raise RuntimeError('request failed')
+    assert crawler.fanout_budget.calls['user_likes'] > calls
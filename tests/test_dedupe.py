@@ -0,0 +1,18 @@
+import numpy as np
+
+from scdata.dedupe import find_near_duplicates
+
+
+def test_near_duplicates_do_not_chain():
+    # A and B share the first half of their signatures, B and C the second half, and A and C
+    # nothing. D is a copy of A.
+    a = np.arange(256, dtype=np.uint32)
+    b = np.concatenate([a[:128], a[128:] + 1000])
+    c = np.concatenate([a[:128] + 2000, b[128:]])
+    signatures = {'a': a, 'b': b, 'c': c, 'd': a.copy()}
+
+    groups, num_candidates = find_near_duplicates(signatures, threshold=0.4)
+    assert num_candidates == 4
+    assert sorted(key for group in groups for key in group) == ['a', 'b', 'c', 'd']
+    assert ['a', 'b', 'd'] in groups
+    assert ['c'] in groups
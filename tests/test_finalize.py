@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+from io import BytesIO
+
+import PIL.Image
+from mutagen.id3 import ID3, APIC
+
+from scdata import SoundCloudCrawler
+from scdata.load import get_audio_path
+
+from conftest import load_tool
+
+finalize = load_tool('finalize')
+
+
+def make_track_info(track_id):
+    return {
+        'id': track_id,
+        'artwork_url': f'https://example.com/{track_id}-large.jpg',
+        'license': 'cc-by',
+        'likes_count': 10,
+        'playback_count': 100,
+        'title': f'Track {track_id}',
+        'genre': 'Techno',
+        'media': {'transcodings': [{'url': 'https://example.com/stream'}]},
+        'duration': 60000,
+        'downloadable': True,
+        'has_downloads_left': True,
+    }
+
+
+def write_dataset(root, track_ids):
+    audio_dir = os.path.join(root, 'audio')
+    image = BytesIO()
+    PIL.Image.new('RGB', (4, 4)).save(image, format='JPEG')
+
+    crawler = SoundCloudCrawler(api=None)
+    with open(os.path.join(root, 'md5sums.txt'), 'w') as f:
+        for track_id in track_ids:
+            crawler.tracks[track_id] = make_track_info(track_id)
+
+            # All tracks share the same cover, which must not affect the splits.
+            audio_path = get_audio_path(audio_dir, track_id)
+            os.makedirs(os.path.dirname(audio_path), exist_ok=True)
+            with open(audio_path, 'wb') as audio_file:
+                audio_file.write(bytes(2000))
+            tags = ID3()
+            tags['APIC'] = APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover',
+                                data=image.getvalue())
+            tags.save(audio_path)
+
+            checksum = hashlib.md5(str(track_id).encode('ascii')).hexdigest()
+            f.write(f'{checksum}  {audio_path}\n')
+
+    crawler.save_state(os.path.join(root, 'crawler_state.json'))
+    return audio_dir
+
+
+def run_finalize(root, audio_dir, out_name, previous_release=None):
+    out_file = os.path.join(root, out_name)
+    finalize.finalize_dataset(audio_dir=audio_dir,
+                              crawler_state=os.path.join(root, 'crawler_state.json'),
+                              out_file=out_file,
+                              p_dev=0.1,
+                              p_test=0.1,
+                              checksum_file=os.path.join(root, 'md5sums.txt'),
+                              min_tracks_per_genre=1,
+                              previous_release=previous_release,
+                              artwork_dir=None,
+                              mp3_scan_cache=None)
+    with open(out_file) as f:
+        return {int(track_id): info['scdata_split'] for track_id, info in json.load(f).items()}
+
+
+def test_splits_are_stable(tmp_path):
+    root = str(tmp_path)
+    audio_dir = write_dataset(root, range(1000, 1200))
+    splits = run_finalize(root, audio_dir, 'first.json')
+
+    assert len(splits) == 200
+    assert set(splits.values()) == {'training', 'validation', 'test'}
+
+    # Running again must give the same splits, also when tracks are added.
+    assert run_finalize(root, audio_dir, 'second.json') == splits
+
+    audio_dir = write_dataset(root, range(1000, 1300))
+    more_splits = run_finalize(root, audio_dir, 'third.json')
+    assert {track_id: more_splits[track_id] for track_id in splits} == splits
+    assert run_finalize(root, audio_dir, 'fourth.json', os.path.join(root, 'first.json')) \
+        == more_splits
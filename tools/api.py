@@ -8,6 +8,7 @@ import aiohttp
 import dotenv
 
 from scdata import SoundCloudAPI
+from scdata.api import collect
 
 
 async def main(config):
@@ -23,13 +24,13 @@ async def main(config):
         print('track genre:', track['genre'])
         print('track artwork:', track['artwork_url'])
 
-        likers = await api.track_likers(info['id'])
+        likers = await collect(api.track_likers(info['id'], limit=10))
         print('liker:', likers[0]['kind'], likers[0]['id'])
 
         info = await api.resolve('https://soundcloud.com/user727372658')
         print('user:', info['id'], info['kind'])
 
-        followings = await api.user_followings(info['id'])
+        followings = await collect(api.user_followings(info['id'], limit=10))
         print('following:', followings[0]['id'], followings[0]['kind'])
 
         info = await api.resolve('https://soundcloud.com/digitalstreams/sets/newtracks')
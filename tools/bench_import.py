@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Measure how long it takes to import the lightweight part of the scdata package.
+
+Importing `scdata` and using the genre and load utilities must not pull in the dependencies of the
+API and the crawler. Exits with a non-zero status if it does, or if the import takes longer than
+the given threshold, so this can be used to guard against regressions.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+# Modules that must not be imported by the lightweight part of the package.
+HEAVY_MODULES = ['aiohttp', 'mutagen', 'numpy', 'msgspec', 'orjson']
+
+SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import scdata
+scdata.map_genre('Techno')
+scdata.get_audio_path('audio', 123456)
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed_ms': elapsed * 1000.0, 'modules': sorted(sys.modules)}))
+"""
+
+
+def measure_import():
+    # Import in a fresh interpreter, so that nothing is cached in `sys.modules`.
+    output = subprocess.run([sys.executable, '-c', SNIPPET],
+                            check=True,
+                            capture_output=True,
+                            text=True).stdout
+    return json.loads(output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--max_ms',
+                        help='Maximum allowed import time in milliseconds (best of all runs)',
+                        default=50.0,
+                        type=float)
+    parser.add_argument('--runs',
+                        help='Number of runs',
+                        default=5,
+                        type=int)
+    args = parser.parse_args()
+
+    results = [measure_import() for _ in range(args.runs)]
+    best_ms = min(result['elapsed_ms'] for result in results)
+
+    heavy_modules = [module for module in results[0]['modules']
+                     if module.split('.')[0] in HEAVY_MODULES]
+
+    print(f'Import time: {best_ms:.2f}ms (best of {args.runs})')
+    print(f'Heavy modules imported: {heavy_modules}')
+
+    if heavy_modules or best_ms > args.max_ms:
+        print('FAILED')
+        sys.exit(1)
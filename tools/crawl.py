@@ -1,23 +1,53 @@
 #!/usr/bin/env python3
+"""
+Crawl SoundCloud for playlists and tracks, starting from a seed playlist.
 
+With `--record_trace`, all API responses are recorded to a trace file. With `--replay_trace`, the
+crawl runs offline against a previously recorded trace, e.g. for comparing changes to the playlist
+score on identical data. Requests that are missing in the trace make the current step fail.
+
+When a new trace is recorded, the crawler state it starts from is stored next to it, and replays
+start from that state. A replay only writes its state if `--crawler_state` is given, so that it
+cannot overwrite the state of a live crawl.
+"""
+
+import argparse
 import os
+import random
 
 import asyncio
 import aiohttp
 
 import dotenv
 
-from scdata import SoundCloudAPI, SoundCloudCrawler
+from scdata import SoundCloudAPI, SoundCloudCrawler, decode
+from scdata.trace import Trace, get_initial_state_path
+
 
+async def main(args, config):
+    trace = None
+    if args.record_trace is not None:
+        trace = Trace(args.record_trace, mode='record')
+    elif args.replay_trace is not None:
+        trace = Trace(args.replay_trace, mode='replay')
 
-async def main(config):
     async with aiohttp.ClientSession() as session:
         api = SoundCloudAPI(session,
-                            client_id=config['SC_CLIENT_ID'],
-                            oauth_token=config['SC_OAUTH_TOKEN'])
-        crawler = SoundCloudCrawler(api)
-        if os.path.exists('crawler_state.json'):
-            crawler.load_state('crawler_state.json')
+                            client_id=config.get('SC_CLIENT_ID', ''),
+                            oauth_token=config.get('SC_OAUTH_TOKEN', ''),
+                            typed=decode.DECODERS is not None,
+                            trace=trace)
+        crawler = SoundCloudCrawler(api, sketch_non_free_tracks=args.sketch_non_free_tracks)
+        if args.replay_trace is not None:
+            if os.path.exists(trace.initial_state_path):
+                crawler.load_state(trace.initial_state_path)
+        elif args.crawler_state is not None and os.path.exists(args.crawler_state):
+            crawler.load_state(args.crawler_state)
+
+        # When appending to an existing trace, keep the state that the first recording started from,
+        # since its responses are still part of the trace.
+        if args.record_trace is not None and not os.path.exists(trace.initial_state_path):
+            crawler.save_state(trace.initial_state_path)
 
         urls = [
             'https://soundcloud.com/tilohensel/sets/creative-commons-music',
@@ -26,10 +56,54 @@ async def main(config):
         for url in urls:
             await crawler.add_candidate_playlist_url(url)
 
-        await crawler.crawl(max_steps=100001, save_path='crawler_state.json')
+        await crawler.crawl(max_steps=args.max_steps, save_path=args.crawler_state)
+
+    if trace is not None:
+        trace.close()
 
 if __name__ == '__main__':
-    config = dotenv.dotenv_values('.env')
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--crawler_state',
+                        help='Path of the crawler state JSON to resume from and to write to '
+                             '(default: crawler_state.json). With --replay_trace, the replay '
+                             'starts from the state stored with the trace, and its state is only '
+                             'written to this path if it is given')
+    parser.add_argument('--max_steps',
+                        help='Number of crawl steps',
+                        default=100001,
+                        type=int)
+    parser.add_argument('--record_trace',
+                        help='Record all API responses to this trace file')
+    parser.add_argument('--replay_trace',
+                        help='Serve all API responses from this trace file instead of SoundCloud')
+    parser.add_argument('--seed',
+                        help='Random seed for choosing playlists, for reproducible replays',
+                        type=int)
+    parser.add_argument('--sketch_non_free_tracks',
+                        help='Only keep counters and a Bloom filter for non-free tracks, instead of '
+                             'a stub per track. Shrinks the crawler state considerably. Existing '
+                             'stubs are converted when resuming',
+                        action='store_true')
+    parser.add_argument('--env',
+                        help='Env file that contains the SC_CLIENT_ID and SC_OAUTH_TOKEN fields',
+                        default='.env')
+    args = parser.parse_args()
+
+    if args.record_trace is not None and args.replay_trace is not None:
+        parser.error('Only one of --record_trace and --replay_trace can be given')
+
+    if args.replay_trace is not None:
+        initial_state_path = get_initial_state_path(args.replay_trace)
+        if args.crawler_state is not None \
+                and os.path.abspath(args.crawler_state) == os.path.abspath(initial_state_path):
+            parser.error('--crawler_state must not be the initial state of the trace')
+    elif args.crawler_state is None:
+        args.crawler_state = 'crawler_state.json'
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    config = dotenv.dotenv_values(args.env)
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main(config))
+    loop.run_until_complete(main(args, config))
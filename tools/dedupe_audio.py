@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Find near-duplicate tracks by their audio, e.g. re-uploads with a different bitrate or trimmed
+silence, which have different MD5 checksums.
+
+Computes a spectral fingerprint of each MP3 file in a process pool (requires `ffmpeg`), and groups
+the tracks with an LSH index over MinHash signatures of the fingerprints. The clusters are written
+in the format of `md5sums.txt`, with a cluster key instead of the checksum, so that the output can
+be passed to `finalize.py --checksum_file`.
+"""
+
+import argparse
+import base64
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from scdata.dedupe import MinHasher, UnionFind, find_near_duplicates
+from scdata.fingerprint import fingerprint_file
+
+_min_hasher = None
+
+
+def _init_worker(num_perm, seed):
+    global _min_hasher
+    _min_hasher = MinHasher(num_perm, seed)
+
+
+def _signature_job(path):
+    try:
+        tokens = fingerprint_file(path)
+    except Exception as e:
+        return path, {'error': str(e)}
+
+    # Signatures of empty token sets (e.g. silent files) would all be equal.
+    if len(tokens) == 0:
+        return path, {'signature': None}
+
+    signature = _min_hasher.signature(tokens)
+    return path, {'signature': base64.b64encode(signature.astype('<u4').tobytes()).decode('ascii')}
+
+
+def find_audio_files(audio_dir):
+    for root, _, filenames in os.walk(audio_dir):
+        for filename in filenames:
+            if filename.endswith('.mp3'):
+                yield os.path.join(root, filename)
+
+
+def compute_signatures(paths, cache_path, num_perm, seed, processes):
+    """
+    Compute the MinHash signatures of the given files. Like `scdata.mp3.scan_mp3_files`, results
+    are cached by file size and modification time.
+    """
+    params = {'num_perm': num_perm, 'seed': seed}
+
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached['params'] == params:
+            cache = cached['files']
+
+    results = {}
+    missing = {}
+    for path in paths:
+        stat = os.stat(path)
+        entry = cache.get(path)
+        if entry is not None and entry['size'] == stat.st_size \
+                and entry['mtime_ns'] == stat.st_mtime_ns:
+            results[path] = entry['result']
+        else:
+            missing[path] = stat
+
+    print(f'Fingerprinting {len(missing)} files ({len(results)} cached)')
+    if missing:
+        with Pool(processes, initializer=_init_worker, initargs=(num_perm, seed)) as pool:
+            for path, result in pool.imap_unordered(_signature_job, missing.keys(), chunksize=4):
+                results[path] = result
+                if 'error' not in result:
+                    cache[path] = {
+                        'size': missing[path].st_size,
+                        'mtime_ns': missing[path].st_mtime_ns,
+                        'result': result,
+                    }
+
+        if cache_path is not None:
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'params': params, 'files': cache}, f)
+            os.replace(tmp_path, cache_path)
+
+    return results
+
+
+def load_exact_groups(checksum_file):
+    groups = {}
+    with open(checksum_file) as f:
+        for line in f:
+            checksum, path = line.strip().split()
+            groups.setdefault(checksum, []).append(path)
+    return groups.values()
+
+
+def get_track_id(path):
+    return int(os.path.basename(path).split('.')[0])
+
+
+def dedupe_audio(audio_dir,
+                 out_file,
+                 cache,
+                 checksum_file,
+                 processes,
+                 num_perm,
+                 num_bands,
+                 threshold,
+                 seed):
+    paths = sorted(find_audio_files(audio_dir))
+    print(f'Found {len(paths)} MP3 files in "{audio_dir}"')
+
+    results = compute_signatures(paths, cache, num_perm, seed, processes)
+    num_errors = sum(1 for result in results.values() if 'error' in result)
+    num_empty = sum(1 for result in results.values() if result.get('signature', '') is None)
+    print(f'#errors: {num_errors}, #empty: {num_empty}')
+
+    signatures = {
+        path: np.frombuffer(base64.b64decode(results[path]['signature']), dtype='<u4')
+        for path in paths
+        if results[path].get('signature') is not None
+    }
+    groups, num_candidates = find_near_duplicates(signatures,
+                                                  num_bands=num_bands,
+                                                  threshold=threshold)
+    print(f'Compared {num_candidates} candidate pairs')
+
+    # Every file ends up in a cluster, also the ones that could not be fingerprinted. Optionally,
+    # exact duplicates are merged too, which covers identical files that could not be decoded.
+    clusters = UnionFind()
+    for path in paths:
+        clusters.find(path)
+    for group in groups:
+        for path in group[1:]:
+            clusters.union(group[0], path)
+    if checksum_file is not None:
+        for group in load_exact_groups(checksum_file):
+            group = [path for path in group if path in results]
+            for path in group[1:]:
+                clusters.union(group[0], path)
+
+    clusters = clusters.groups()
+    num_duplicates = sum(len(cluster) - 1 for cluster in clusters)
+    print(f'Found {len(clusters)} clusters, {num_duplicates} duplicates')
+
+    # The smallest track ID is a stable key for a cluster, as long as no older track joins it.
+    print(f'Writing clusters to "{out_file}"')
+    with open(out_file, 'w') as f:
+        for cluster in sorted(clusters, key=lambda cluster: min(map(get_track_id, cluster))):
+            key = min(map(get_track_id, cluster))
+            for path in sorted(cluster, key=get_track_id):
+                f.write(f'{key}  {path}\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--audio_dir',
+                        help='Directory that contains the MP3 audio files',
+                        required=True)
+    parser.add_argument('--out_file',
+                        help='Path of the cluster file to be written, e.g. audio/clusters.txt',
+                        required=True)
+    parser.add_argument('--cache',
+                        help='JSON file for caching the signatures of the files',
+                        default=None)
+    parser.add_argument('--checksum_file',
+                        help='MD5 checksum file (see readme). If given, exact duplicates are '
+                             'always put into the same cluster',
+                        default=None)
+    parser.add_argument('--processes',
+                        help='Number of worker processes (default: number of CPUs)',
+                        default=None,
+                        type=int)
+    parser.add_argument('--num_perm',
+                        help='Size of the MinHash signatures',
+                        default=256,
+                        type=int)
+    parser.add_argument('--num_bands',
+                        help='Number of LSH bands. Must divide --num_perm. More bands find less '
+                             'similar duplicates, but produce more candidate pairs',
+                        default=128,
+                        type=int)
+    parser.add_argument('--threshold',
+                        help='Minimum estimated Jaccard similarity of the fingerprint tokens of '
+                             'two duplicates. Unrelated tracks are usually close to 0',
+                        default=0.05,
+                        type=float)
+    parser.add_argument('--seed',
+                        help='Seed of the MinHash permutations',
+                        default=1,
+                        type=int)
+    args = parser.parse_args()
+
+    if args.num_perm % args.num_bands != 0:
+        parser.error('--num_bands must divide --num_perm')
+
+    print(f'Arguments: {json.dumps(vars(args), indent=4)}')
+
+    dedupe_audio(**vars(args))
@@ -4,6 +4,7 @@ Finalize dataset creation and write JSON file with metadata.
 """
 
 import argparse
+import hashlib
 import os
 import json
 from collections import defaultdict, Counter
@@ -12,10 +13,10 @@ from io import BytesIO
 import PIL.Image
 from mutagen.id3 import ID3
 
-from numpy import random
-
 from scdata import SoundCloudAPI, SoundCloudCrawler, map_genre
+from scdata.artwork import ArtworkStore
 from scdata.load import get_audio_path
+from scdata.mp3 import scan_mp3_files, is_mp3_okay
 
 
 def load_checksums(checksum_file):
@@ -47,21 +48,59 @@ def load_checksums(checksum_file):
     return tracks_by_checksum, num_checksum_tracks
 
 
-def sample_unique(tracks_by_checksum):
+def load_previous_release(previous_file):
+    """
+    Load the metadata JSON file of a previous release, if given.
+
+    Tracks that are part of the previous release keep their split, and they are not validated
+    again.
+    """
+    if previous_file is None:
+        return {}
+
+    with open(previous_file) as f:
+        return {int(track_id): track_info for track_id, track_info in json.load(f).items()}
+
+
+def sample_unique(tracks_by_checksum, previous_tracks):
     """
-    Select one track from each group of tracks that has the same checksum.
+    Select one track from each group of tracks that has the same checksum (or, with the output of
+    `dedupe_audio.py`, the same cluster key).
+
+    While the MP3 files are (nearly) identical, the metadata as returned by the SoundCloud API could still
+    be different, so we need choose one representative per group. The choice is deterministic:
+    prefer a track that was already part of the previous release, and otherwise the one with the
+    smallest ID.
 
-    While the MP3 files are identical, the metadata as returned by the SoundCloud API could still
-    be different, so we need choose one representative per group.
+    Returns a dictionary mapping from the checksum to the representative track.
     """
-    unique_tracks = []
+    unique_tracks = {}
 
-    for tracks in tracks_by_checksum.values():
-        unique_tracks.append(random.choice(tracks))
+    for checksum, tracks in tracks_by_checksum.items():
+        previous = [track_id for track_id in tracks if track_id in previous_tracks]
+        unique_tracks[checksum] = min(previous) if previous else min(tracks)
 
     return unique_tracks
 
 
+def hash_split(key, p_dev, p_test):
+    """
+    Assign a split based on a stable hash of the given key.
+
+    Unlike sampling the splits, this does not depend on which other tracks are in the dataset, so
+    adding tracks does not move existing tracks between splits.
+    """
+    digest = hashlib.sha1(str(key).encode('utf-8')).digest()
+    value = int.from_bytes(digest[:8], 'big') / 2**64
+
+    if value < p_test:
+        return 'test'
+    elif value < p_test + p_dev:
+        return 'validation'
+    else:
+        return 'training'
+
+
 def finalize_dataset(audio_dir,
                      crawler_state,
                      out_file,
@@ -69,14 +108,18 @@ def finalize_dataset(audio_dir,
                      p_test,
                      checksum_file,
                      min_tracks_per_genre,
-                     seed):
-    random.seed(args.seed)
+                     previous_release,
+                     artwork_dir,
+                     mp3_scan_cache):
+    # The train/dev/test split is assigned per track below.
+    assert p_test > 0.0
+    assert p_dev > 0.0
+    assert p_dev + p_test < 1.0
 
-    print(f'Loading track MP3 checksums from "{checksum_file}"')
-    tracks_by_checksum, num_checksum_tracks = load_checksums(checksum_file)
-    unique_tracks = sample_unique(tracks_by_checksum)
+    previous_tracks = load_previous_release(previous_release)
+    print(f'Loaded {len(previous_tracks)} tracks of the previous release')
 
-    print(f'Sampled {len(unique_tracks)} unique tracks out of {num_checksum_tracks}')
+    artwork_store = ArtworkStore(artwork_dir) if artwork_dir is not None else None
 
     # Load track metadata from crawler state.
     print(f'Loading crawler state from "{crawler_state}"')
@@ -85,65 +128,116 @@ def finalize_dataset(audio_dir,
     crawler.print_info()
     print('Finished loading crawler state')
 
+    print(f'Loading track MP3 checksums from "{checksum_file}"')
+    tracks_by_checksum, num_checksum_tracks = load_checksums(checksum_file)
+
+    # Downloaded tracks can be missing from the crawler state, or only be kept as stubs there (e.g.
+    # states refreshed by older versions stripped tracks that were not free anymore). Tracks of the
+    # previous release fall back to their released metadata, the others are skipped.
+    track_infos = {}
+    num_missing = 0
+    for checksum in list(tracks_by_checksum):
+        for track_id in tracks_by_checksum[checksum]:
+            track_info = crawler.tracks.get(track_id)
+            if track_info is None or not crawler.is_complete_track_info(track_info) \
+                    or 'duration' not in track_info:
+                track_info = previous_tracks.get(track_id)
+            if track_info is not None:
+                track_infos[track_id] = track_info
+            else:
+                num_missing += 1
+
+        tracks_by_checksum[checksum] = [track_id for track_id in tracks_by_checksum[checksum]
+                                        if track_id in track_infos]
+        if not tracks_by_checksum[checksum]:
+            del tracks_by_checksum[checksum]
+    print(f'Skipped {num_missing} tracks without metadata in the crawler state')
+
+    unique_tracks = sample_unique(tracks_by_checksum, previous_tracks)
+
+    print(f'Sampled {len(unique_tracks)} unique tracks out of {num_checksum_tracks}')
+
     # Count tracks per genre to filter out rare genres.
     num_tracks_by_genre = Counter()
-    for track_id in unique_tracks:
-        track_info = crawler.tracks[track_id]
+    for track_id in unique_tracks.values():
+        track_info = track_infos[track_id]
         num_tracks_by_genre[map_genre(track_info['genre'])] += 1
     print(f'Genre counts: {num_tracks_by_genre.most_common()}')
 
+    # Scan the frames of the new MP3 files, to detect truncated downloads and to get their actual
+    # duration. Results are cached, so this only needs to be done once per file.
+    mp3_scans = None
+    if mp3_scan_cache is not None:
+        audio_paths = [get_audio_path(audio_dir, track_id) for track_id in unique_tracks.values()
+                       if track_id not in previous_tracks]
+        print(f'Scanning {len(audio_paths)} MP3 files')
+        mp3_scans = scan_mp3_files(audio_paths, cache_path=mp3_scan_cache)
+        num_bad = sum(1 for scan in mp3_scans.values() if not is_mp3_okay(scan))
+        print(f'Found {num_bad} truncated or invalid MP3 files')
+
     # Filter tracks:
     #tracks_by_user = defaultdict(list)
     filtered_tracks = []
-    for track_id in unique_tracks:
-        track_info = crawler.tracks[track_id]
+    num_validated = 0
+    for checksum, track_id in unique_tracks.items():
+        track_info = track_infos[track_id]
+
+        # Tracks of the previous release have already passed the checks below.
+        if track_id in previous_tracks:
+            track_info['scdata_split'] = previous_tracks[track_id]['scdata_split']
+            filtered_tracks.append(track_info)
+            continue
 
         # A couple of tracks seem to have bad image data.
+        num_validated += 1
         audio_path = get_audio_path(audio_dir, track_info['id'])
         try:
-            tags = ID3(audio_path)
-            PIL.Image.open(BytesIO(tags.getall('APIC')[0].data))
+            # Fall back to the embedded artwork for tracks whose artwork is not in the store.
+            artwork_checksum = None
+            if artwork_store is not None:
+                artwork_checksum = artwork_store.get_track_checksum(track_info)
+            if artwork_checksum is not None:
+                artwork = artwork_store.read(artwork_checksum)
+            else:
+                artwork = ID3(audio_path).getall('APIC')[0].data
+            PIL.Image.open(BytesIO(artwork))
         except:
             continue
 
         if num_tracks_by_genre[map_genre(track_info['genre'])] < min_tracks_per_genre:
             continue
 
-        if track_info['duration'] < 10000:
+        duration = track_info['duration']
+        if mp3_scans is not None:
+            if not is_mp3_okay(mp3_scans[audio_path]):
+                continue
+            duration = mp3_scans[audio_path]['duration']
+
+        if duration < 10000:
             continue
 
-        if track_info['duration'] > 900000:
+        if duration > 900000:
             continue
 
         if os.path.getsize(audio_path) < 1000:
             continue
 
+        # Hash the checksum rather than the track ID, so that duplicates can never end up in
+        # different splits.
+        track_info['scdata_split'] = hash_split(checksum, p_dev, p_test)
         filtered_tracks.append(track_info)
         #tracks_by_user[track_info['user_id']].append(track_info)
 
     #print(f'Found users: {len(tracks_by_user)}')
     #print(f'Tracks per user: {len(filtered_tracks)/len(tracks_by_user):.4f}')
+    print(f'Validated {num_validated} new tracks')
     print(f'Ignored {len(unique_tracks) - len(filtered_tracks)} tracks')
 
-    # Perform the train/dev/test split.
-    assert p_test > 0.0
-    assert p_dev > 0.0
-    assert p_dev + p_test < 1.0
-
-    splits = random.choice(['training', 'validation', 'test'],
-                           len(filtered_tracks),
-                           p=[1.0 - p_dev - p_test, p_dev, p_test])
-
-    split_counts = Counter()
-
-    for split, track_info in zip(splits, filtered_tracks):
-        track_info['scdata_split'] = split
-        split_counts[split] += 1
-
+    split_counts = Counter(track_info['scdata_split'] for track_info in filtered_tracks)
     print(f'Split counts: {split_counts}')
 
     # Write metadata file.
-    print(f'Writing metadata JSON to "{args.out_file}"')
+    print(f'Writing metadata JSON to "{out_file}"')
     with open(out_file, 'w') as f:
         tracks = {track_info['id']: track_info for track_info in filtered_tracks}
         json.dump(tracks, f, indent=4)
@@ -169,16 +263,25 @@ if __name__ == '__main__':
                         default=0.05,
                         type=float)
     parser.add_argument('--checksum_file',
-                        help='File computing the checksums precomputed for each track',
+                        help='File computing the checksums precomputed for each track, or the '
+                             'near-duplicate clusters written by dedupe_audio.py',
                         required=True)
     parser.add_argument('--min_tracks_per_genre',
                         help='Minimum number of tracks per genre',
                         default=100,
                         type=int)
-    parser.add_argument('--seed',
-                        help='Random seed',
-                        default=43,
-                        type=int)
+    parser.add_argument('--previous_release',
+                        help='Metadata JSON of a previous release. Its tracks keep their split, '
+                             'and only new tracks are validated',
+                        default=None)
+    parser.add_argument('--artwork_dir',
+                        help='Artwork store written by scrape.py. If given, covers are validated '
+                             'from the store instead of from the MP3 files',
+                        default=None)
+    parser.add_argument('--mp3_scan_cache',
+                        help='If given, scan the MP3 frames to filter out truncated files and to '
+                             'get the actual durations. Results are cached in this JSON file',
+                        default=None)
     args = parser.parse_args()
 
     print(f'Arguments: {json.dumps(vars(args), indent=4)}')
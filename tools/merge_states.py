@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Merge several crawler states into one, without loading any of them fully into memory.
+
+Each input state is parsed incrementally. Its tracks, visited sets and candidate playlists are
+written to disk as runs of at most `--run_size` items that are sorted by ID, and the runs of all
+inputs are then merged with a k-way merge, while the output state is written out directly.
+
+Conflicts are resolved by last writer wins: of the different infos of a track, the one that was
+fetched last (see `scdata_fetched_at`) is kept, and otherwise the one of the input that comes last
+on the command line. The same goes for candidate playlists, which are dropped altogether if any of
+the inputs has visited them. Visited sets are united, and track sketches are combined (with
+approximate counts).
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import tempfile
+from collections import Counter
+
+from scdata.sketch import TrackSketch
+
+# Sections of the state that can be large, and the other sections, which are small.
+LIST_SECTIONS = ['visited_tracks', 'visited_playlists', 'visited_users']
+DICT_SECTIONS = ['candidate_playlists', 'tracks']
+
+WHITESPACE = ' \t\n\r'
+
+
+class JSONStreamReader:
+    """
+    Incremental reader for a JSON document, which only keeps a small part of it in memory.
+
+    Containers can be iterated element by element, while all other values are decoded with
+    `json.JSONDecoder.raw_decode`. If a value is cut off at the end of the buffer, more of the file
+    is read and the value is decoded again.
+    """
+
+    def __init__(self, f, chunk_size: int = 1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Read at least as much as is left in the buffer, so that decoding a long value again and
+        # again takes amortized linear time.
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError('Unexpected end of JSON document')
+            self.fill()
+
+    def consume(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f'Expected "{char}" at "{self.buffer[self.pos:self.pos + 20]}"')
+        self.pos += 1
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the next chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def iter_items(self, open_char: str, close_char: str):
+        self.consume(open_char)
+        if self.peek() == close_char:
+            self.pos += 1
+            return
+
+        while True:
+            yield
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.consume(close_char)
+                return
+
+    def iter_array(self):
+        for _ in self.iter_items('[', ']'):
+            yield self.read_value()
+
+    def iter_object_keys(self):
+        """
+        Iterate over the keys of an object. The caller needs to read the value of each key (with
+        `read_value`, or by iterating it) before continuing.
+        """
+        for _ in self.iter_items('{', '}'):
+            key = self.read_value()
+            self.consume(':')
+            yield key
+
+    def iter_object(self):
+        for key in self.iter_object_keys():
+            yield key, self.read_value()
+
+
+def write_sorted_run(items, tmp_dir, runs):
+    items.sort(key=lambda item: (item[0], item[1]))
+    fd, path = tempfile.mkstemp(suffix='.jsonl', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as f:
+        for item in items:
+            f.write(json.dumps(item))
+            f.write('\n')
+    runs.append(path)
+    items.clear()
+
+
+def split_state(path, input_index, tmp_dir, run_size, runs):
+    """
+    Read a crawler state, and write its large sections as sorted runs of `[id, input_index, value]`
+    items. Returns the small sections.
+    """
+    small_sections = {}
+
+    with open(path) as f:
+        reader = JSONStreamReader(f)
+        for section in reader.iter_object_keys():
+            if section in LIST_SECTIONS or section in DICT_SECTIONS:
+                if section in LIST_SECTIONS:
+                    items = ((value, None) for value in reader.iter_array())
+                else:
+                    items = ((int(key), value) for key, value in reader.iter_object())
+
+                buffer = []
+                for key, value in items:
+                    buffer.append([key, input_index, value])
+                    if len(buffer) >= run_size:
+                        write_sorted_run(buffer, tmp_dir, runs[section])
+                if buffer:
+                    write_sorted_run(buffer, tmp_dir, runs[section])
+            else:
+                small_sections[section] = reader.read_value()
+
+    return small_sections
+
+
+def read_run(path):
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def merge_runs(paths):
+    """
+    Merge sorted runs, and group the items by ID. Produces `(id, items)` pairs, in the order of
+    the IDs, where the items are in input order.
+    """
+    merged = heapq.merge(*[read_run(path) for path in paths],
+                         key=lambda item: (item[0], item[1]))
+    for key, items in itertools.groupby(merged, key=lambda item: item[0]):
+        yield key, list(items)
+
+
+def choose_track(items):
+    # Last writer wins. Stripped tracks (and tracks of older states) have no fetch time.
+    return max(items, key=lambda item: (item[2].get('scdata_fetched_at', 0), item[1]))[2]
+
+
+def merge_small_sections(states):
+    """
+    Merge the small sections of the input states. Values of the last state win, except for
+    counters and sketches, which are combined.
+    """
+    merged = {}
+    for state in states:
+        merged.update(state)
+
+    if 'num_candidate_insertions' in merged:
+        merged['num_candidate_insertions'] = max(state.get('num_candidate_insertions', 0)
+                                                 for state in states)
+
+    sketches = [TrackSketch.from_state_dict(state['track_sketch'])
+                for state in states if 'track_sketch' in state]
+    if sketches:
+        sketch = sketches[0]
+        for other in sketches[1:]:
+            sketch.seen.update(other.seen)
+            sketch.num_tracks += other.num_tracks
+            sketch.licenses.update(other.licenses)
+            sketch.genres.update(other.genres)
+
+        # The Bloom filters are united exactly, but tracks that were counted by several inputs
+        # would be counted multiple times. Scale the counters down to the estimated number of
+        # distinct tracks in the united filter.
+        if len(sketches) > 1 and sketch.num_tracks > 0:
+            scale = min(1.0, sketch.seen.estimate_size() / sketch.num_tracks)
+            sketch.num_tracks = round(sketch.num_tracks * scale)
+            for counter in [sketch.licenses, sketch.genres]:
+                for key in counter:
+                    counter[key] = round(counter[key] * scale)
+            print(f'Merged {len(sketches)} track sketches, with an estimated '
+                  f'{sketch.num_tracks} distinct tracks')
+
+        merged['track_sketch'] = sketch.state_dict()
+
+    for key in ['min_track_likes', 'min_track_plays']:
+        values = set(state[key] for state in states if key in state)
+        if len(values) > 1:
+            print(f'Warning: inputs have different values for {key}: {sorted(values)}, '
+                  f'using {merged[key]}')
+
+    return merged
+
+
+def write_key(f, key, first):
+    if not first:
+        f.write(', ')
+    f.write(f'{json.dumps(key)}: ')
+
+
+def merge_states(in_files, out_file, run_size, tmp_dir):
+    stats = Counter()
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        runs = {section: [] for section in LIST_SECTIONS + DICT_SECTIONS}
+        states = []
+        for input_index, path in enumerate(in_files):
+            print(f'Splitting "{path}" into sorted runs')
+            states.append(split_state(path, input_index, run_dir, run_size, runs))
+        print(f'Wrote {sum(len(paths) for paths in runs.values())} runs')
+
+        small_sections = merge_small_sections(states)
+
+        print(f'Writing merged state to "{out_file}"')
+        tmp_path = out_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('{')
+            first = True
+            for section, value in small_sections.items():
+                write_key(f, section, first)
+                f.write(json.dumps(value))
+                first = False
+
+            for section in LIST_SECTIONS:
+                write_key(f, section, first)
+                f.write('[')
+                first = False
+                for i, (key, items) in enumerate(merge_runs(runs[section])):
+                    f.write(', ' if i > 0 else '')
+                    f.write(json.dumps(key))
+                    stats[section] += 1
+                    stats[f'{section}_duplicates'] += len(items) - 1
+                f.write(']')
+
+            # Candidates that have been visited by any of the inputs are dropped. Both are sorted by
+            # ID, so this is a merge join.
+            write_key(f, 'candidate_playlists', first)
+            f.write('{')
+            visited_playlists = (key for key, _ in merge_runs(runs['visited_playlists']))
+            visited_playlist = next(visited_playlists, None)
+            num_written = 0
+            for key, items in merge_runs(runs['candidate_playlists']):
+                while visited_playlist is not None and visited_playlist < key:
+                    visited_playlist = next(visited_playlists, None)
+                if visited_playlist == key:
+                    stats['visited_candidates'] += 1
+                    continue
+                write_key(f, str(key), num_written == 0)
+                f.write(json.dumps(items[-1][2]))
+                num_written += 1
+            stats['candidate_playlists'] = num_written
+            f.write('}')
+
+            write_key(f, 'tracks', first=False)
+            f.write('{')
+            for i, (key, items) in enumerate(merge_runs(runs['tracks'])):
+                write_key(f, str(key), i == 0)
+                f.write(json.dumps(choose_track(items)))
+                stats['tracks'] += 1
+                stats['track_conflicts'] += len(items) - 1
+            f.write('}')
+
+            f.write('}')
+        os.replace(tmp_path, out_file)
+
+    for key, count in stats.items():
+        print(f'#{key}: {count}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--in_files',
+                        help='Crawler state JSON files to merge. For conflicts, later files win',
+                        nargs='+',
+                        required=True)
+    parser.add_argument('--out_file',
+                        help='Path of the merged crawler state JSON',
+                        required=True)
+    parser.add_argument('--run_size',
+                        help='Number of items per sorted run, which bounds the memory usage',
+                        default=100000,
+                        type=int)
+    parser.add_argument('--tmp_dir',
+                        help='Directory for the sorted runs (default: system temp directory)',
+                        default=None)
+    args = parser.parse_args()
+
+    if os.path.abspath(args.out_file) in map(os.path.abspath, args.in_files):
+        parser.error('--out_file must not be one of the --in_files')
+
+    merge_states(args.in_files, args.out_file, args.run_size, args.tmp_dir)
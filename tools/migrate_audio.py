@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Migrate an audio directory to a different layout in place.
+
+Moves every file that belongs to a track (the `.mp3` file, as well as e.g. extracted `.jpg` covers
+next to it) to its path in the new layout, and updates the layout marker at the end. The renames
+are done in parallel. If the migration is interrupted, it can simply be run again.
+
+Do not run other tools on the audio directory while migrating it.
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from scdata.load import LAYOUT_VERSIONS, get_layout_version, set_layout_version, get_audio_path
+
+
+def find_track_files(audio_dir):
+    """
+    Find all files in the subdirectories of the audio directory that are named after a track ID.
+    """
+    for root, _, filenames in os.walk(audio_dir):
+        if root == audio_dir:
+            continue
+        for filename in filenames:
+            # Split at the first dot, so that e.g. partial downloads (`.mp3.part`) are moved too.
+            stem, dot, ext = filename.partition('.')
+            ext = dot + ext
+            if stem.isdigit():
+                yield os.path.join(root, filename), int(stem), ext
+
+
+def move_file(path, new_path):
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    os.rename(path, new_path)
+
+
+def remove_empty_dirs(audio_dir):
+    for root, dirnames, filenames in os.walk(audio_dir, topdown=False):
+        if root != audio_dir and not dirnames and not filenames:
+            os.rmdir(root)
+
+
+def rewrite_checksum_file(checksum_file, audio_dir, version):
+    """
+    Update the paths in a checksum file (see `finalize.py`) to the new layout.
+    """
+    lines = []
+    with open(checksum_file) as f:
+        for line in f:
+            checksum, path = line.strip().split()
+            stem, ext = os.path.splitext(os.path.basename(path))
+            lines.append(f'{checksum}  {get_audio_path(audio_dir, int(stem), version, ext)}\n')
+
+    tmp_path = checksum_file + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, checksum_file)
+
+
+def migrate(audio_dir, version, checksum_files, workers):
+    print(f'Migrating "{audio_dir}" from layout version {get_layout_version(audio_dir)} to '
+          f'{version}')
+
+    moves = []
+    for path, track_id, ext in find_track_files(audio_dir):
+        new_path = get_audio_path(audio_dir, track_id, version, ext)
+        if path != new_path:
+            moves.append((path, new_path))
+
+    print(f'Moving {len(moves)} files')
+    with ThreadPoolExecutor(workers) as executor:
+        for _ in executor.map(lambda move: move_file(*move), moves):
+            pass
+
+    remove_empty_dirs(audio_dir)
+    set_layout_version(audio_dir, version)
+
+    for checksum_file in checksum_files:
+        print(f'Rewriting paths in "{checksum_file}"')
+        rewrite_checksum_file(checksum_file, audio_dir, version)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--audio_dir', help='Audio directory to migrate', required=True)
+    parser.add_argument('--version',
+                        help='Layout version to migrate to',
+                        default=2,
+                        choices=LAYOUT_VERSIONS,
+                        type=int)
+    parser.add_argument('--checksum_files',
+                        help='Checksum files whose paths should be updated, e.g. '
+                             'audio/md5sums.txt',
+                        nargs='*',
+                        default=[])
+    parser.add_argument('--workers',
+                        help='Number of parallel renames',
+                        default=32,
+                        type=int)
+    args = parser.parse_args()
+
+    migrate(args.audio_dir, args.version, args.checksum_files, args.workers)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Refresh the metadata of complete tracks in the crawler state.
+
+Licenses and download availability change over time. Run this before scraping, so that we do not
+try to download tracks that are no longer free or available.
+"""
+
+import argparse
+
+import asyncio
+import aiohttp
+
+import dotenv
+
+from scdata import SoundCloudAPI, SoundCloudCrawler, decode
+
+
+async def main(args, config):
+    async with aiohttp.ClientSession() as session:
+        api = SoundCloudAPI(session,
+                            client_id=config['SC_CLIENT_ID'],
+                            oauth_token=config['SC_OAUTH_TOKEN'],
+                            typed=decode.DECODERS is not None)
+
+        print(f'Loading crawler state from "{args.crawler_state}"')
+        crawler = SoundCloudCrawler(api)
+        crawler.load_state(args.crawler_state)
+        print('Finished loading crawler state')
+
+        await crawler.refresh_tracks(max_calls=args.max_calls,
+                                     batch_size=args.batch_size,
+                                     min_age=args.min_age_days * 24 * 3600)
+
+        print(f'Writing crawler state to "{args.crawler_state}"')
+        crawler.save_state(args.crawler_state)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--crawler_state',
+                        help='Path of the crawler state JSON, as written by crawl.py',
+                        required=True)
+    parser.add_argument('--max_calls',
+                        help='Maximum number of API calls',
+                        default=1000,
+                        type=int)
+    parser.add_argument('--batch_size',
+                        help='Number of tracks to request per API call',
+                        default=50,
+                        type=int)
+    parser.add_argument('--min_age_days',
+                        help='Only refresh tracks that were fetched at least this many days ago',
+                        default=7.0,
+                        type=float)
+    parser.add_argument('--env',
+                        help='Env file that contains the SC_CLIENT_ID and SC_OAUTH_TOKEN fields',
+                        default='.env')
+    args = parser.parse_args()
+
+    config = dotenv.dotenv_values(args.env)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args, config))
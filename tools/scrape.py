@@ -13,11 +13,81 @@ import aiohttp
 import dotenv
 
 from scdata import SoundCloudAPI, SoundCloudCrawler
-from scdata.load import get_audio_path
+from scdata.artwork import ArtworkStore, get_artwork_url, read_embedded_artwork
+from scdata.dedupe import find_metadata_duplicates
+from scdata.load import LAYOUT_VERSIONS, get_audio_path, get_layout_version, set_layout_version
 from scdata.genre import map_genre
+from scdata.mp3 import is_mp3_okay, scan_mp3_files
 
 
-async def main(crawler_state, out_audio_dir, config):
+def write_cover_checksums(artwork_store, tracks, out_audio_dir):
+    """
+    Write the checksums of the track covers in the format of `md5sums.txt`, for deduplicating by
+    cover in `finalize.py`.
+    """
+    path = os.path.join(out_audio_dir, 'md5sums.covers.txt')
+    num_tracks = 0
+
+    with open(path, 'w') as f:
+        for track_info in tracks:
+            audio_path = get_audio_path(out_audio_dir, track_info['id'])
+            checksum = artwork_store.get_track_checksum(track_info)
+            if checksum is not None and os.path.exists(audio_path):
+                f.write(f'{checksum}  {audio_path}\n')
+                num_tracks += 1
+
+    print(f'Wrote cover checksums of {num_tracks} tracks to "{path}"')
+
+
+def is_download_okay(track_info, scan):
+    """
+    Check the scan of a downloaded track. Downloads that were interrupted by older versions (which
+    did not write to `.part` files first) can be truncated, or even end on a complete frame.
+    """
+    if not is_mp3_okay(scan):
+        return False
+    return scan['duration'] >= 0.9 * (track_info.get('duration') or 0)
+
+
+def get_duplicate_track_ids(tracks, out_audio_dir):
+    """
+    Find the tracks that are likely duplicates of another track according to their metadata.
+
+    From each group of duplicates, we keep a track that has already been downloaded, or otherwise
+    the most played one. Returns the IDs of the other tracks.
+    """
+    groups = find_metadata_duplicates(tracks)
+    duplicate_track_ids = set()
+
+    for group in groups:
+        if len(group) == 1:
+            continue
+
+        downloaded = [track_info for track_info in group
+                      if os.path.exists(get_audio_path(out_audio_dir, track_info['id']))]
+        if downloaded:
+            representative = min(downloaded, key=lambda track_info: track_info['id'])
+        else:
+            representative = max(group, key=lambda track_info: (track_info['playback_count'] or 0,
+                                                                -track_info['id']))
+
+        for track_info in group:
+            if track_info is not representative:
+                duplicate_track_ids.add(track_info['id'])
+
+    print(f'Found {len(duplicate_track_ids)} likely duplicates in '
+          f'{sum(1 for group in groups if len(group) > 1)} groups')
+
+    return duplicate_track_ids
+
+
+async def main(crawler_state,
+               out_audio_dir,
+               artwork_dir,
+               embed_artwork,
+               skip_duplicates,
+               mp3_scan_cache,
+               config):
     async with aiohttp.ClientSession() as session:
         api = SoundCloudAPI(session,
                             client_id=config['SC_CLIENT_ID'],
@@ -39,12 +109,65 @@ async def main(crawler_state, out_audio_dir, config):
         print(f'Complete tracks: {len(tracks)}/{len(crawler.tracks)}')
 
         missing_tracks = []
+        downloaded_tracks = []
         for track_info in tracks:
             audio_path = get_audio_path(out_audio_dir, track_info['id'])
             if not os.path.exists(audio_path) or os.path.getsize(audio_path) == 0:
                 missing_tracks.append((track_info, audio_path))
-
-        print(f'Missing tracks: {len(missing_tracks)}')
+            else:
+                downloaded_tracks.append((track_info, audio_path))
+
+        print(f'Scanning {len(downloaded_tracks)} downloaded MP3 files')
+        mp3_scans = scan_mp3_files([audio_path for _, audio_path in downloaded_tracks],
+                                   cache_path=mp3_scan_cache)
+        bad_tracks = [(track_info, audio_path) for track_info, audio_path in downloaded_tracks
+                      if not is_download_okay(track_info, mp3_scans[audio_path])]
+        print(f'Downloading {len(bad_tracks)} truncated or invalid MP3 files again')
+        missing_tracks += bad_tracks
+        downloaded_tracks = [(track_info, audio_path) for track_info, audio_path in downloaded_tracks
+                             if is_download_okay(track_info, mp3_scans[audio_path])]
+
+        num_partial = sum(1 for _, audio_path in missing_tracks
+                          if os.path.exists(audio_path + '.part'))
+        print(f'Missing tracks: {len(missing_tracks)} ({num_partial} partially downloaded)')
+
+        # Likely duplicates would most likely be removed by `finalize.py` anyway. Download them
+        # only after all other tracks, or not at all.
+        duplicate_track_ids = get_duplicate_track_ids(tracks, out_audio_dir)
+        duplicate_tracks = [(track_info, audio_path) for track_info, audio_path in missing_tracks
+                            if track_info['id'] in duplicate_track_ids]
+        missing_tracks = [(track_info, audio_path) for track_info, audio_path in missing_tracks
+                          if track_info['id'] not in duplicate_track_ids]
+        if skip_duplicates:
+            print(f'Skipping {len(duplicate_tracks)} likely duplicates')
+        else:
+            print(f'Deferring {len(duplicate_tracks)} likely duplicates')
+            missing_tracks += duplicate_tracks
+
+        artwork_store = None
+        if artwork_dir is not None:
+            artwork_store = ArtworkStore(artwork_dir)
+            # Tracks that were downloaded by earlier runs (possibly without --artwork_dir) need
+            # their artwork in the store as well, for the cover checksums and for `finalize.py`.
+            artwork_urls = set(get_artwork_url(track_info)
+                               for track_info, _ in missing_tracks + downloaded_tracks)
+            artwork_urls = set(url for url in artwork_urls if artwork_store.get_checksum(url) is None)
+            print(f'Fetching {len(artwork_urls)} distinct artworks')
+            artwork_fails = await artwork_store.fetch_all(session, artwork_urls)
+            print(f'#artwork_fails: {artwork_fails}')
+
+            # If the artwork of a downloaded track could not be fetched (anymore), take the one that
+            # is embedded into its MP3 file.
+            num_embedded = 0
+            for track_info, audio_path in downloaded_tracks:
+                if artwork_store.get_track_checksum(track_info) is None:
+                    artwork = read_embedded_artwork(audio_path)
+                    if artwork is not None:
+                        artwork_store.add(get_artwork_url(track_info), artwork)
+                        num_embedded += 1
+            if num_embedded > 0:
+                print(f'Took {num_embedded} artworks from the MP3 files')
+                artwork_store.save_index()
 
         fails = 0
         for track_info, audio_path in tqdm(missing_tracks):
@@ -54,13 +177,20 @@ async def main(crawler_state, out_audio_dir, config):
                   map_genre(track_info['genre']))
             os.makedirs(os.path.dirname(audio_path), exist_ok=True)
             try:
-                await api.save_track(track_info, audio_path)
+                await api.save_track(track_info,
+                                     audio_path,
+                                     artwork_store=artwork_store,
+                                     embed_artwork=embed_artwork)
             except Exception as e:
                 fails += 1
                 print(f'Caught exception {e}')
 
         print(f'#fails: {fails}')
 
+        if artwork_store is not None:
+            artwork_store.save_index()
+            write_cover_checksums(artwork_store, tracks, out_audio_dir)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
@@ -68,12 +198,47 @@ if __name__ == '__main__':
                         help='Path of the crawler state JSON, as written by crawl.py',
                         required=True)
     parser.add_argument('--out_audio_dir', help='Directory to save tracks in', required=True)
+    parser.add_argument('--artwork_dir',
+                        help='Directory of the content-addressed artwork store. If given, each '
+                             'distinct artwork is downloaded only once')
+    parser.add_argument('--layout_version',
+                        help='Layout of the audio directory. Can only be chosen for a new '
+                             'directory; use migrate_audio.py for existing ones',
+                        choices=LAYOUT_VERSIONS,
+                        type=int)
+    parser.add_argument('--no_embed_artwork',
+                        help='Do not embed the artwork into the MP3 files (requires --artwork_dir)',
+                        action='store_true')
+    parser.add_argument('--skip_duplicates',
+                        help='Do not download tracks that are likely duplicates of another track '
+                             'according to their metadata. By default, they are downloaded last',
+                        action='store_true')
+    parser.add_argument('--mp3_scan_cache',
+                        help='JSON file for caching the MP3 scans of the downloaded files, which '
+                             'are used to detect truncated files. Can be shared with finalize.py',
+                        default=None)
     parser.add_argument('--env',
                         help='Env file that contains the SC_CLIENT_ID and SC_OAUTH_TOKEN fields',
                         default='.env')
     args = parser.parse_args()
 
+    if args.no_embed_artwork and args.artwork_dir is None:
+        parser.error('--no_embed_artwork requires --artwork_dir')
+
+    if args.layout_version is not None \
+            and args.layout_version != get_layout_version(args.out_audio_dir):
+        if os.path.exists(args.out_audio_dir) and os.listdir(args.out_audio_dir):
+            parser.error(f'"{args.out_audio_dir}" already uses layout version '
+                         f'{get_layout_version(args.out_audio_dir)}, see migrate_audio.py')
+        set_layout_version(args.out_audio_dir, args.layout_version)
+
     config = dotenv.dotenv_values(args.env)
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main(args.crawler_state, args.out_audio_dir, config))
+    loop.run_until_complete(main(args.crawler_state,
+                                 args.out_audio_dir,
+                                 args.artwork_dir,
+                                 not args.no_embed_artwork,
+                                 args.skip_duplicates,
+                                 args.mp3_scan_cache,
+                                 config))